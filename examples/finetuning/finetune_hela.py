@@ -59,6 +59,9 @@ def get_dataloader(split, patch_shape, batch_size):
         ndim=2, is_seg_dataset=True, rois=roi,
         label_transform=torch_em.transform.label.connected_components,
         num_workers=8, shuffle=True,
+        # pinned memory enables asynchronous transfer of the batches to the GPU,
+        # persistent workers avoid restarting the worker processes for every epoch
+        pin_memory=True, persistent_workers=True,
     )
     return loader
 
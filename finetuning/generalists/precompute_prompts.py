@@ -1,9 +1,10 @@
 import argparse
 import os
-import pickle
 
 from subprocess import run
 
+import numpy as np
+
 import micro_sam.evaluation as evaluation
 from util import get_data_paths, ALL_DATASETS, LM_DATASETS
 from tqdm import tqdm
@@ -39,15 +40,15 @@ def _check_prompts(dataset, settings, expected_len):
 
     def check_prompt_file(prompt_file):
         assert os.path.exists(prompt_file), prompt_file
-        with open(prompt_file, "rb") as f:
-            prompts = pickle.load(f)
+        with np.load(prompt_file) as f:
+            prompts = f["names"]
         assert len(prompts) == expected_len, f"{len(prompts)}, {expected_len}"
 
     for setting in settings:
         pos, neg = setting["n_positives"], setting["n_negatives"]
-        prompt_file = os.path.join(prompt_folder, f"points-p{pos}-n{neg}.pkl")
+        prompt_file = os.path.join(prompt_folder, f"points-p{pos}-n{neg}.npz")
         if pos == 0 and neg == 0:
-            prompt_file = os.path.join(prompt_folder, "boxes.pkl")
+            prompt_file = os.path.join(prompt_folder, "boxes.npz")
         check_prompt_file(prompt_file)
 
 
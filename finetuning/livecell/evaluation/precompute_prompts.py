@@ -1,8 +1,9 @@
 import argparse
 import os
-import pickle
 from subprocess import run
 
+import numpy as np
+
 import micro_sam.evaluation as evaluation
 from tqdm import tqdm
 from util import get_paths, PROMPT_FOLDER
@@ -25,15 +26,15 @@ def check_settings(settings):
 
     def check_prompt_file(prompt_file):
         assert os.path.exists(prompt_file), prompt_file
-        with open(prompt_file, "rb") as f:
-            prompts = pickle.load(f)
+        with np.load(prompt_file) as f:
+            prompts = f["names"]
         assert len(prompts) == 1512, f"{len(prompts)}"
 
     for setting in tqdm(settings, desc="Check prompt files"):
         pos, neg = setting["n_positives"], setting["n_negatives"]
-        prompt_file = os.path.join(PROMPT_FOLDER, f"points-p{pos}-n{neg}.pkl")
+        prompt_file = os.path.join(PROMPT_FOLDER, f"points-p{pos}-n{neg}.npz")
         if pos == 0 and neg == 0:
-            prompt_file = os.path.join(PROMPT_FOLDER, "boxes.pkl")
+            prompt_file = os.path.join(PROMPT_FOLDER, "boxes.npz")
         check_prompt_file(prompt_file)
 
     print("All files checked!")
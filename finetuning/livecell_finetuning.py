@@ -21,12 +21,14 @@ def get_dataloaders(patch_shape, data_path, cell_type=None):
     Important: the ID 0 is reseved for background, and the IDs must be consecutive
     """
     label_transform = torch_em.transform.label.label_consecutive  # to ensure consecutive IDs
+    # keep the workers alive across epochs and prefetch a few batches per worker to keep the GPU busy
+    loader_kwargs = {"pin_memory": True, "persistent_workers": True, "prefetch_factor": 4}
     train_loader = get_livecell_loader(path=data_path, patch_shape=patch_shape, split="train", batch_size=2,
                                        num_workers=16, cell_types=cell_type, download=True,
-                                       label_transform=label_transform, shuffle=True)
+                                       label_transform=label_transform, shuffle=True, **loader_kwargs)
     val_loader = get_livecell_loader(path=data_path, patch_shape=patch_shape, split="val", batch_size=1,
                                      num_workers=16, cell_types=cell_type, download=True,
-                                     label_transform=label_transform, shuffle=True)
+                                     label_transform=label_transform, shuffle=True, **loader_kwargs)
     return train_loader, val_loader
 
 
@@ -52,6 +54,10 @@ def finetune_livecell(args):
     # this class creates all the training data for a batch (inputs, prompts and labels)
     convert_inputs = sam_training.ConvertToSamInputs()
 
+    # the patch shape and batch size are fixed, so cudnn can select the fastest convolution algorithms once
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+
     checkpoint_name = "livecell_sam"
     # the trainer which performs training and validation (implemented using "torch_em")
     trainer = sam_training.SamTrainer(
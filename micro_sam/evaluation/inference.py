@@ -1,14 +1,22 @@
 """Inference with Segment Anything models and different prompt strategies.
 """
 
+import hashlib
+import multiprocessing as mp
 import os
 import pickle
+import tempfile
+import warnings
+from collections import deque
+from concurrent import futures
+from functools import lru_cache, partial
 import numpy as np
 from tqdm import tqdm
-from copy import deepcopy
 from typing import Any, Dict, List, Optional, Union
 
 import imageio.v3 as imageio
+import tifffile
+import zarr
 from skimage.segmentation import relabel_sequential
 
 import torch
@@ -21,6 +29,61 @@ from ..instance_segmentation import mask_data_to_segmentation
 from ..prompt_generators import PointAndBoxPromptGenerator, IterativePromptGenerator
 
 
+def _save_prompt_file(prompt_file, prompts):
+    # Save the prompts of all images as flat arrays in a single npz file.
+    # The number of objects varies per image, so we store the offsets into the flat arrays for each image name.
+    names = list(prompts.keys())
+    values = list(prompts.values())
+    n_objects = [len(val[0]) if isinstance(val, tuple) else len(val) for val in values]
+    offsets = np.concatenate([[0], np.cumsum(n_objects)]).astype("int64")
+
+    arrays = {}
+    if len(values) > 0 and isinstance(values[0], tuple):
+        arrays["points"] = np.concatenate([val[0] for val in values], axis=0)
+        arrays["labels"] = np.concatenate([val[1] for val in values], axis=0)
+    elif len(values) > 0:
+        arrays["boxes"] = np.concatenate(values, axis=0)
+
+    np.savez(prompt_file, names=np.array(names, dtype="str"), offsets=offsets, **arrays)
+
+
+def _convert_legacy_prompt_file(prompt_file):
+    # Prompts were previously cached as pickle files. If only such a file exists we convert it to the npz format,
+    # so that the prompts of earlier experiments are still used.
+    legacy_prompt_file = f"{os.path.splitext(prompt_file)[0]}.pkl"
+    if os.path.exists(prompt_file) or not os.path.exists(legacy_prompt_file):
+        return
+    warnings.warn(f"Converting the prompts cached in the legacy format {legacy_prompt_file} to {prompt_file}.")
+    with open(legacy_prompt_file, "rb") as f:
+        prompts = pickle.load(f)
+    _save_prompt_file(prompt_file, prompts)
+
+
+def _load_prompt_file(prompt_file):
+    # The modification time is part of the cache key, so that we reload the prompts if the file was rewritten.
+    return _load_prompt_file_cached(prompt_file, os.stat(prompt_file).st_mtime_ns)
+
+
+# We memoize loading the prompt files, so that running several experiments with the same prompts
+# in one process loads each file only once. The cache holds the point and the box prompts of one setting.
+@lru_cache(maxsize=2)
+def _load_prompt_file_cached(prompt_file, mtime):
+    # Load the flat prompt arrays and the lookup table from image name to the range of objects in these arrays.
+    with np.load(prompt_file) as f:
+        arrays = {key: f[key] for key in f.files}
+    names, offsets = arrays.pop("names"), arrays.pop("offsets")
+    ranges = {str(name): (start, stop) for name, start, stop in zip(names, offsets[:-1], offsets[1:])}
+    return arrays, ranges
+
+
+def _get_prompts_from_file(prompt_data, image_name):
+    arrays, ranges = prompt_data
+    start, stop = ranges[image_name]
+    if "boxes" in arrays:
+        return arrays["boxes"][start:stop]
+    return arrays["points"][start:stop], arrays["labels"][start:stop]
+
+
 def _load_prompts(
     cached_point_prompts, save_point_prompts,
     cached_box_prompts, save_box_prompts,
@@ -34,10 +97,9 @@ def _load_prompts(
 
         # we have cached prompts, but they have not been loaded yet
         if isinstance(cached_prompts, str):
-            with open(cached_prompts, "rb") as f:
-                cached_prompts = pickle.load(f)
+            cached_prompts = _load_prompt_file(cached_prompts)
 
-        prompts = cached_prompts[image_name]
+        prompts = _get_prompts_from_file(cached_prompts, image_name)
         return cached_prompts, prompts
 
     cached_point_prompts, point_prompts = load_prompt_type(cached_point_prompts, save_point_prompts)
@@ -61,6 +123,15 @@ def _load_prompts(
     return prompts, cached_point_prompts, cached_box_prompts
 
 
+def _get_object_masks(gt, gt_ids):
+    # Compute the object masks with a single broadcasted comparison.
+    # This is cheaper than 'util.segmentation_to_one_hot', which relabels and scatters the segmentation.
+    gt_tensor = torch.from_numpy(gt.astype("int64"))
+    id_tensor = torch.from_numpy(np.asarray(gt_ids, dtype="int64"))
+    masks = (gt_tensor[None] == id_tensor[:, None, None]).unsqueeze(1).to(torch.float32)
+    return masks
+
+
 def _get_batched_prompts(
     gt,
     gt_ids,
@@ -69,6 +140,7 @@ def _get_batched_prompts(
     n_positives,
     n_negatives,
     dilation,
+    masks=None,
 ):
     # Initialize the prompt generator.
     prompt_generator = PointAndBoxPromptGenerator(
@@ -81,7 +153,8 @@ def _get_batched_prompts(
     center_coordinates, bbox_coordinates = util.get_centers_and_bounding_boxes(gt)
     center_coordinates = [center_coordinates[gt_id] for gt_id in gt_ids]
     bbox_coordinates = [bbox_coordinates[gt_id] for gt_id in gt_ids]
-    masks = util.segmentation_to_one_hot(gt.astype("int64"), gt_ids)
+    if masks is None:
+        masks = _get_object_masks(gt, gt_ids)
 
     points, point_labels, boxes, _ = prompt_generator(
         masks, bbox_coordinates, center_coordinates
@@ -107,6 +180,7 @@ def _run_inference_with_prompts_for_image(
     batch_size,
     cached_prompts,
     embedding_path,
+    use_fp16,
 ):
     gt_ids = np.unique(gt)[1:]
     if cached_prompts is None:
@@ -116,8 +190,9 @@ def _run_inference_with_prompts_for_image(
     else:
         points, point_labels, boxes = cached_prompts
 
-    # Make a copy of the point prompts to return them at the end.
-    prompts = deepcopy((points, point_labels, boxes))
+    # Keep a reference to the prompts to return them at the end.
+    # We don't need to copy them, because batched_inference does not modify the prompts in place.
+    prompts = (points, point_labels, boxes)
 
     # Use multi-masking only if we have a single positive point without box
     multimasking = False
@@ -128,7 +203,7 @@ def _run_inference_with_prompts_for_image(
         predictor, image, batch_size,
         boxes=boxes, points=points, point_labels=point_labels,
         multimasking=multimasking, embedding_path=embedding_path,
-        return_instance_segmentation=True,
+        return_instance_segmentation=True, use_fp16=use_fp16,
     )
 
     return instance_labels, prompts
@@ -140,6 +215,7 @@ def get_predictor(
     device: Optional[str] = None,
     return_state: bool = False,
     is_custom_model: Optional[bool] = None,
+    compile_model: bool = False,
 ) -> SamPredictor:
     """Get the segment anything predictor from an exported or custom checkpoint.
 
@@ -148,6 +224,7 @@ def get_predictor(
         model_type: The type of the model, either vit_h, vit_b or vit_l.
         return_state: Whether to return the complete state of the checkpoint in addtion to the predictor.
         is_custom_model: Whether this is a custom model or not.
+        compile_model: Whether to compile the image encoder with `torch.compile` for faster inference.
     Returns:
         The segment anything predictor.
     """
@@ -166,13 +243,86 @@ def get_predictor(
         predictor = util.get_sam_model(
             model_type=model_type, device=device, checkpoint_path=checkpoint_path
         )  # type: ignore
+
+    # Use the channels last memory layout for the image encoder, which enables faster convolution kernels.
+    model = predictor[0].model if return_state else predictor.model
+    model.image_encoder = model.image_encoder.to(memory_format=torch.channels_last)
+
+    if compile_model:
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("Compiling the model requires pytorch 2.0 or newer.")
+        # The image encoder always receives inputs of the same shape (1024 x 1024),
+        # so we can use CUDA graphs to reduce the kernel launch overhead.
+        model.image_encoder = torch.compile(model.image_encoder, mode="reduce-overhead")
+
     return predictor
 
 
+def _has_valid_embeddings(predictor, image, embedding_path):
+    # Check whether the embeddings were computed already and, if so, whether they were computed
+    # for the same image and model. This follows the checks in 'util.precompute_image_embeddings'.
+    f = zarr.open(embedding_path, "a")
+    if "input_size" not in f.attrs:
+        return False
+
+    key_vals = [("data_signature", util._compute_data_signature(image)), ("model_type", predictor.model_type)]
+    for key, val in key_vals:
+        if key not in f.attrs or f.attrs[key] != val:
+            raise RuntimeError(
+                f"Embeddings file {embedding_path} is invalid due to unmatching {key}: "
+                f"{f.attrs.get(key)} != {val}.Please recompute embeddings in a new file."
+            )
+    return True
+
+
+@torch.inference_mode()
+def _precompute_batched_embeddings(predictor, images, embedding_paths, use_fp16):
+    # We only compute the embeddings that don't exist yet.
+    to_compute = [
+        i for i, (image, embedding_path) in enumerate(zip(images, embedding_paths))
+        if not _has_valid_embeddings(predictor, image, embedding_path)
+    ]
+    if len(to_compute) == 0:
+        return
+    images = [images[i] for i in to_compute]
+    embedding_paths = [embedding_paths[i] for i in to_compute]
+
+    # Bring the images to the input format of the image encoder.
+    # This follows the preprocessing in 'SamPredictor.set_image'.
+    input_images, original_sizes, input_sizes = [], [], []
+    for image in images:
+        image = util._to_image(image)
+        input_image = predictor.transform.apply_image(image)
+        input_image = torch.as_tensor(input_image, device=predictor.device).permute(2, 0, 1).contiguous()[None]
+        original_sizes.append(image.shape[:2])
+        input_sizes.append(tuple(input_image.shape[-2:]))
+        input_images.append(predictor.model.preprocess(input_image))
+
+    # Run the image encoder for all images in the batch at once.
+    # If requested we use half precision on the GPU and cast the features back to float32 before saving them.
+    with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=use_fp16 and predictor.device.type == "cuda"):
+        input_images = torch.cat(input_images).contiguous(memory_format=torch.channels_last)
+        features = predictor.model.image_encoder(input_images)
+    features = features.float().cpu().numpy()
+
+    # Save the embeddings in the same format as 'util.precompute_image_embeddings'.
+    for i, (image, embedding_path) in enumerate(zip(images, embedding_paths)):
+        f = zarr.open(embedding_path, "a")
+        f.attrs["data_signature"] = util._compute_data_signature(image)
+        f.attrs["tile_shape"] = None
+        f.attrs["halo"] = None
+        f.attrs["model_type"] = predictor.model_type
+        f.create_dataset("features", data=features[i:i+1], chunks=features[i:i+1].shape, overwrite=True)
+        f.attrs["input_size"] = input_sizes[i]
+        f.attrs["original_size"] = original_sizes[i]
+
+
 def precompute_all_embeddings(
     predictor: SamPredictor,
     image_paths: List[Union[str, os.PathLike]],
     embedding_dir: Union[str, os.PathLike],
+    batch_size: int = 1,
+    use_fp16: bool = False,
 ) -> None:
     """Precompute all image embeddings.
 
@@ -182,34 +332,116 @@ def precompute_all_embeddings(
         predictor: The SegmentAnything predictor.
         image_paths: The image file paths.
         embedding_dir: The directory where the embeddings will be saved.
+        batch_size: The number of images that are passed to the image encoder at once.
+        use_fp16: Whether to run the image encoder in half precision on the GPU.
+            The embeddings are always saved as float32. This uses the batched code path, also for batch_size=1.
     """
-    for image_path in tqdm(image_paths, desc="Precompute embeddings"):
+    def get_embedding_path(image_path):
         image_name = os.path.basename(image_path)
-        im = imageio.imread(image_path)
-        embedding_path = os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
-        util.precompute_image_embeddings(predictor, im, embedding_path, ndim=2)
+        return os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
+
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    if len(batches) == 0:
+        return
+
+    def load_batch(paths):
+        return [imageio.imread(path) for path in paths]
+
+    # We load the next images in a background thread while the embeddings for the current images are computed.
+    with futures.ThreadPoolExecutor(max_workers=1) as tp:
+        next_batch = tp.submit(load_batch, batches[0])
+        for i, batch_paths in tqdm(enumerate(batches), total=len(batches), desc="Precompute embeddings"):
+            images = next_batch.result()
+            if i + 1 < len(batches):
+                next_batch = tp.submit(load_batch, batches[i + 1])
+
+            embedding_paths = [get_embedding_path(image_path) for image_path in batch_paths]
+            if batch_size == 1 and not use_fp16:
+                util.precompute_image_embeddings(predictor, images[0], embedding_paths[0], ndim=2)
+            else:
+                _precompute_batched_embeddings(predictor, images, embedding_paths, use_fp16)
+
+
+def _get_gt_cache_path(gt_path, cache_dir):
+    # The cache file is keyed on the full path and the modification time of the ground-truth,
+    # so that files with the same name in different folders don't collide and changed files are reloaded.
+    stat = os.stat(gt_path)
+    key = f"{os.path.abspath(gt_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    name = os.path.splitext(os.path.basename(gt_path))[0]
+    return os.path.join(cache_dir, f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+
+
+def _load_gt(gt_path, cache_dir=None):
+    # If a cache directory is given we store the relabeled ground-truth there,
+    # so that it doesn't have to be decoded and relabeled again for other experiments.
+    if cache_dir is not None:
+        cache_path = _get_gt_cache_path(gt_path, cache_dir)
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+    # We read tif files with tifffile directly and avoid the copy for casting to uint32
+    # if the data already has this dtype.
+    if os.path.splitext(gt_path)[1].lower() in (".tif", ".tiff"):
+        gt = tifffile.imread(gt_path)
+    else:
+        gt = imageio.imread(gt_path)
+    gt = relabel_sequential(gt.astype("uint32", copy=False))[0]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first and move it into place, so that concurrent readers
+        # never see a partially written cache file.
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, gt)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
+    return gt
 
-def _precompute_prompts(gt_path, use_points, use_boxes, n_positives, n_negatives, dilation):
+
+def _get_gt_cache_dir(prompt_save_dir):
+    return None if prompt_save_dir is None else os.path.join(prompt_save_dir, "ground_truth")
+
+
+def _get_prompt_save_path(prompt_save_dir, use_points, use_boxes, n_positives, n_negatives):
+    if use_boxes and not use_points:
+        return os.path.join(prompt_save_dir, "boxes.npz")
+    return os.path.join(prompt_save_dir, f"points-p{n_positives}-n{n_negatives}.npz")
+
+
+def _precompute_prompts(gt_path, prompt_settings, gt_cache_dir):
     name = os.path.basename(gt_path)
 
-    gt = imageio.imread(gt_path).astype("uint32")
-    gt = relabel_sequential(gt)[0]
+    # We load the ground-truth only once and then compute the prompts for all settings.
+    gt = _load_gt(gt_path, gt_cache_dir)
     gt_ids = np.unique(gt)[1:]
+    masks = _get_object_masks(gt, gt_ids)
 
-    input_point, input_label, input_box = _get_batched_prompts(
-        gt, gt_ids, use_points, use_boxes, n_positives, n_negatives, dilation
-    )
+    prompts = []
+    for settings in prompt_settings:
+        use_points, use_boxes = settings["use_points"], settings["use_boxes"]
+        input_point, input_label, input_box = _get_batched_prompts(
+            gt, gt_ids, use_points, use_boxes, settings["n_positives"], settings["n_negatives"],
+            settings.get("dilation", 5), masks=masks,
+        )
+        if use_boxes and not use_points:
+            prompts.append(input_box)
+        else:
+            prompts.append((input_point, input_label))
 
-    if use_boxes and not use_points:
-        return name, input_box
-    return name, (input_point, input_label)
+    return name, prompts
 
 
 def precompute_all_prompts(
     gt_paths: List[Union[str, os.PathLike]],
     prompt_save_dir: Union[str, os.PathLike],
     prompt_settings: List[Dict[str, Any]],
+    n_workers: int = 1,
 ) -> None:
     """Precompute all point prompts.
 
@@ -219,51 +451,64 @@ def precompute_all_prompts(
         gt_paths: The file paths to the ground-truth segmentations.
         prompt_save_dir: The directory where the prompt files will be saved.
         prompt_settings: The settings for which the prompts will be computed.
+        n_workers: The number of processes used to compute the prompts for the ground-truth files in parallel.
+            Each process holds the object masks of one ground-truth image in memory.
+            The processes are started with 'spawn', so scripts that use more than one worker
+            need to call this function from within an `if __name__ == "__main__":` block.
     """
     os.makedirs(prompt_save_dir, exist_ok=True)
 
-    for settings in tqdm(prompt_settings, desc="Precompute prompts"):
-
-        use_points, use_boxes = settings["use_points"], settings["use_boxes"]
-        n_positives, n_negatives = settings["n_positives"], settings["n_negatives"]
-        dilation = settings.get("dilation", 5)
-
-        # check if the prompts were already computed
-        if use_boxes and not use_points:
-            prompt_save_path = os.path.join(prompt_save_dir, "boxes.pkl")
-        else:
-            prompt_save_path = os.path.join(prompt_save_dir, f"points-p{n_positives}-n{n_negatives}.pkl")
-        if os.path.exists(prompt_save_path):
+    # check which of the prompts were already computed
+    settings_to_compute, prompt_save_paths = [], []
+    for settings in prompt_settings:
+        prompt_save_path = _get_prompt_save_path(
+            prompt_save_dir, settings["use_points"], settings["use_boxes"],
+            settings["n_positives"], settings["n_negatives"],
+        )
+        _convert_legacy_prompt_file(prompt_save_path)
+        if os.path.exists(prompt_save_path) or prompt_save_path in prompt_save_paths:
             continue
+        settings_to_compute.append(settings)
+        prompt_save_paths.append(prompt_save_path)
+
+    if len(settings_to_compute) == 0:
+        return
+
+    gt_cache_dir = _get_gt_cache_dir(prompt_save_dir)
+    compute_prompts = partial(_precompute_prompts, prompt_settings=settings_to_compute, gt_cache_dir=gt_cache_dir)
+
+    if n_workers > 1:
+        # We use 'spawn' to start the processes, because forking after torch has been initialized can deadlock.
+        # Each process uses a single torch thread, otherwise all processes would compete for all cores.
+        with futures.ProcessPoolExecutor(
+            n_workers, mp_context=mp.get_context("spawn"), initializer=torch.set_num_threads, initargs=(1,)
+        ) as pp:
+            results = list(tqdm(
+                pp.map(compute_prompts, gt_paths, chunksize=4), total=len(gt_paths), desc="Precompute prompts"
+            ))
+    else:
+        results = [compute_prompts(gt_path) for gt_path in tqdm(gt_paths, desc="Precompute prompts")]
 
-        results = []
-        for gt_path in tqdm(gt_paths, desc=f"Precompute prompts for p{n_positives}-n{n_negatives}"):
-            prompts = _precompute_prompts(
-                gt_path,
-                use_points=use_points,
-                use_boxes=use_boxes,
-                n_positives=n_positives,
-                n_negatives=n_negatives,
-                dilation=dilation,
-            )
-            results.append(prompts)
+    saved_prompts = [{} for _ in settings_to_compute]
+    for name, prompts in results:
+        for this_saved_prompts, this_prompts in zip(saved_prompts, prompts):
+            this_saved_prompts[name] = this_prompts
 
-        saved_prompts = {res[0]: res[1] for res in results}
-        with open(prompt_save_path, "wb") as f:
-            pickle.dump(saved_prompts, f)
+    for prompt_save_path, this_saved_prompts in zip(prompt_save_paths, saved_prompts):
+        _save_prompt_file(prompt_save_path, this_saved_prompts)
 
 
 def _get_prompt_caching(prompt_save_dir, use_points, use_boxes, n_positives, n_negatives):
 
-    def get_prompt_type_caching(use_type, save_name):
+    def get_prompt_type_caching(use_type, prompt_save_path):
         if not use_type:
             return None, False, None
 
-        prompt_save_path = os.path.join(prompt_save_dir, save_name)
+        _convert_legacy_prompt_file(prompt_save_path)
         if os.path.exists(prompt_save_path):
             print("Using precomputed prompts from", prompt_save_path)
             # We delay loading the prompts, so we only have to load them once they're needed the first time.
-            # This avoids loading the prompts (which are in a big pickle file) if all predictions are done already.
+            # This avoids loading the prompts (which are in a big npz file) if all predictions are done already.
             cached_prompts = prompt_save_path
             save_prompts = False
         else:
@@ -281,10 +526,10 @@ def _get_prompt_caching(prompt_save_dir, use_points, use_boxes, n_positives, n_n
         point_prompt_save_path, box_prompt_save_path = None, None
     else:
         cached_point_prompts, save_point_prompts, point_prompt_save_path = get_prompt_type_caching(
-            use_points, f"points-p{n_positives}-n{n_negatives}.pkl"
+            use_points, _get_prompt_save_path(prompt_save_dir, True, False, n_positives, n_negatives)
         )
         cached_box_prompts, save_box_prompts, box_prompt_save_path = get_prompt_type_caching(
-            use_boxes, "boxes.pkl"
+            use_boxes, _get_prompt_save_path(prompt_save_dir, False, True, n_positives, n_negatives)
         )
 
     return (cached_point_prompts, save_point_prompts, point_prompt_save_path,
@@ -304,6 +549,7 @@ def run_inference_with_prompts(
     dilation: int = 5,
     prompt_save_dir: Optional[Union[str, os.PathLike]] = None,
     batch_size: int = 512,
+    use_fp16: bool = False,
 ) -> None:
     """Run segment anything inference for multiple images using prompts derived from groundtruth.
 
@@ -321,6 +567,7 @@ def run_inference_with_prompts(
         prompt_save_dir: The directory where point prompts will be saved or are already saved.
             This enables running multiple experiments in a reproducible manner.
         batch_size: The batch size used for batched prediction.
+        use_fp16: Whether to run the prompt encoder and mask decoder in half precision on the GPU.
     """
     if not (use_points or use_boxes):
         raise ValueError("You need to use at least one of point or box prompts.")
@@ -333,54 +580,73 @@ def run_inference_with_prompts(
          prompt_save_dir, use_points, use_boxes, n_positives, n_negatives
      )
 
-    os.makedirs(prediction_dir, exist_ok=True)
-    for image_path, gt_path in tqdm(
-        zip(image_paths, gt_paths), total=len(image_paths), desc="Run inference with prompts"
-    ):
-        image_name = os.path.basename(image_path)
-        label_name = os.path.basename(gt_path)
+    gt_cache_dir = _get_gt_cache_dir(prompt_save_dir)
 
-        # We skip the images that already have been segmented.
-        prediction_path = os.path.join(prediction_dir, image_name)
-        if os.path.exists(prediction_path):
-            continue
-
-        assert os.path.exists(image_path), image_path
-        assert os.path.exists(gt_path), gt_path
+    os.makedirs(prediction_dir, exist_ok=True)
+    write_futures = deque()
+    with futures.ThreadPoolExecutor(max_workers=4) as io_pool:
+        for image_path, gt_path in tqdm(
+            zip(image_paths, gt_paths), total=len(image_paths), desc="Run inference with prompts"
+        ):
+            image_name = os.path.basename(image_path)
+            label_name = os.path.basename(gt_path)
+
+            # We skip the images that already have been segmented.
+            prediction_path = os.path.join(prediction_dir, image_name)
+            if os.path.exists(prediction_path):
+                continue
+
+            assert os.path.exists(image_path), image_path
+            assert os.path.exists(gt_path), gt_path
+
+            im = imageio.imread(image_path)
+            gt = _load_gt(gt_path, gt_cache_dir)
+
+            embedding_path = os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
+            this_prompts, cached_point_prompts, cached_box_prompts = _load_prompts(
+                cached_point_prompts, save_point_prompts,
+                cached_box_prompts, save_box_prompts,
+                label_name
+            )
+            instances, this_prompts = _run_inference_with_prompts_for_image(
+                predictor, im, gt, n_positives=n_positives, n_negatives=n_negatives,
+                dilation=dilation, use_points=use_points, use_boxes=use_boxes,
+                batch_size=batch_size, cached_prompts=this_prompts,
+                embedding_path=embedding_path, use_fp16=use_fp16,
+            )
 
-        im = imageio.imread(image_path)
-        gt = imageio.imread(gt_path).astype("uint32")
-        gt = relabel_sequential(gt)[0]
+            if save_point_prompts:
+                cached_point_prompts[label_name] = this_prompts[:2]
+            if save_box_prompts:
+                cached_box_prompts[label_name] = this_prompts[-1]
 
-        embedding_path = os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
-        this_prompts, cached_point_prompts, cached_box_prompts = _load_prompts(
-            cached_point_prompts, save_point_prompts,
-            cached_box_prompts, save_box_prompts,
-            label_name
-        )
-        instances, this_prompts = _run_inference_with_prompts_for_image(
-            predictor, im, gt, n_positives=n_positives, n_negatives=n_negatives,
-            dilation=dilation, use_points=use_points, use_boxes=use_boxes,
-            batch_size=batch_size, cached_prompts=this_prompts,
-            embedding_path=embedding_path,
-        )
+            # It's important to compress here, otherwise the predictions would take up a lot of space.
+            # We write the predictions in the background, so that the compression does not block inference.
+            _submit_write(io_pool, write_futures, imageio.imwrite, prediction_path, instances, compression=5)
 
-        if save_point_prompts:
-            cached_point_prompts[label_name] = this_prompts[:2]
-        if save_box_prompts:
-            cached_box_prompts[label_name] = this_prompts[-1]
-
-        # It's important to compress here, otherwise the predictions would take up a lot of space.
-        imageio.imwrite(prediction_path, instances, compression=5)
+    # Make sure that errors during writing are not silently ignored.
+    for write_future in write_futures:
+        write_future.result()
 
     # Save the prompts if we run experiments with prompt caching and have computed them
     # for the first time.
     if save_point_prompts:
-        with open(point_prompt_save_path, "wb") as f:
-            pickle.dump(cached_point_prompts, f)
+        _save_prompt_file(point_prompt_save_path, cached_point_prompts)
     if save_box_prompts:
-        with open(box_prompt_save_path, "wb") as f:
-            pickle.dump(cached_box_prompts, f)
+        _save_prompt_file(box_prompt_save_path, cached_box_prompts)
+
+
+# The maximal number of predictions that are written in the background at the same time.
+# This bounds the memory used for predictions that are waiting to be written if writing is slower than inference.
+_MAX_PENDING_WRITES = 8
+
+
+def _submit_write(io_pool, write_futures, write_function, *args, **kwargs):
+    # Wait for the oldest write to finish if too many writes are pending.
+    # Calling result raises the errors of failed writes, so that they are not silently ignored.
+    while len(write_futures) >= _MAX_PENDING_WRITES:
+        write_futures.popleft().result()
+    write_futures.append(io_pool.submit(write_function, *args, **kwargs))
 
 
 def _save_segmentation(masks, prediction_path):
@@ -392,7 +658,7 @@ def _save_segmentation(masks, prediction_path):
     imageio.imwrite(prediction_path, segmentation, compression=5)
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def _run_inference_with_iterative_prompting_for_image(
     predictor,
     image,
@@ -402,8 +668,11 @@ def _run_inference_with_iterative_prompting_for_image(
     batch_size,
     embedding_path,
     n_iterations,
-    prediction_paths
-) -> None:
+    prediction_paths,
+    io_pool,
+    write_futures,
+    use_fp16,
+):
     prompt_generator = IterativePromptGenerator()
 
     gt_ids = np.unique(gt)[1:]
@@ -418,23 +687,26 @@ def _run_inference_with_iterative_prompting_for_image(
         n_positives = 1
         multimasking = True
 
+    # The object masks are needed for the initial prompts and for the iterative prompts,
+    # so we only compute them once.
+    sampled_binary_gt = _get_object_masks(gt, gt_ids)
+
     points, point_labels, boxes = _get_batched_prompts(
         gt, gt_ids,
         use_points=use_points,
         use_boxes=use_boxes,
         n_positives=n_positives,
         n_negatives=0,
-        dilation=dilation
+        dilation=dilation,
+        masks=sampled_binary_gt,
     )
 
-    sampled_binary_gt = util.segmentation_to_one_hot(gt.astype("int64"), gt_ids)
-
     for iteration in range(n_iterations):
         batched_outputs = batched_inference(
             predictor, image, batch_size,
             boxes=boxes, points=points, point_labels=point_labels,
             multimasking=multimasking, embedding_path=embedding_path,
-            return_instance_segmentation=False
+            return_instance_segmentation=False, use_fp16=use_fp16,
         )
 
         # switching off multimasking after first iter, as next iters (with multiple prompts) don't expect multimasking
@@ -455,7 +727,8 @@ def _run_inference_with_iterative_prompting_for_image(
         else:
             point_labels = next_labels
 
-        _save_segmentation(masks, prediction_paths[iteration])
+        # The segmentation is computed and written in the background, so that it doesn't block the next iteration.
+        _submit_write(io_pool, write_futures, _save_segmentation, masks.cpu(), prediction_paths[iteration])
 
 
 def run_inference_with_iterative_prompting(
@@ -468,6 +741,7 @@ def run_inference_with_iterative_prompting(
     dilation: int = 5,
     batch_size: int = 32,
     n_iterations: int = 8,
+    use_fp16: bool = False,
 ) -> None:
     """Run segment anything inference for multiple images using prompts iteratively
         derived from model outputs and groundtruth
@@ -483,6 +757,7 @@ def run_inference_with_iterative_prompting(
             around which points will not be sampled.
         batch_size: The batch size used for batched predictions.
         n_iterations: The number of iterations for iterative prompting.
+        use_fp16: Whether to run the prompt encoder and mask decoder in half precision on the GPU.
     """
     if len(image_paths) != len(gt_paths):
         raise ValueError(f"Expect same number of images and gt images, got {len(image_paths)}, {len(gt_paths)}")
@@ -491,27 +766,36 @@ def run_inference_with_iterative_prompting(
     for i in range(n_iterations):
         os.makedirs(os.path.join(prediction_dir, f"iteration{i:02}"), exist_ok=True)
 
-    for image_path, gt_path in tqdm(
-        zip(image_paths, gt_paths), total=len(image_paths), desc="Run inference with iterative prompting for all images"
-    ):
-        image_name = os.path.basename(image_path)
-
-        # We skip the images that already have been segmented
-        prediction_paths = [os.path.join(prediction_dir, f"iteration{i:02}", image_name) for i in range(n_iterations)]
-        if all(os.path.exists(prediction_path) for prediction_path in prediction_paths):
-            continue
-
-        assert os.path.exists(image_path), image_path
-        assert os.path.exists(gt_path), gt_path
-
-        image = imageio.imread(image_path)
-        gt = imageio.imread(gt_path).astype("uint32")
-        gt = relabel_sequential(gt)[0]
-
-        embedding_path = os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
+    write_futures = deque()
+    with futures.ThreadPoolExecutor(max_workers=4) as io_pool:
+        for image_path, gt_path in tqdm(
+            zip(image_paths, gt_paths), total=len(image_paths),
+            desc="Run inference with iterative prompting for all images",
+        ):
+            image_name = os.path.basename(image_path)
+
+            # We skip the images that already have been segmented
+            prediction_paths = [
+                os.path.join(prediction_dir, f"iteration{i:02}", image_name) for i in range(n_iterations)
+            ]
+            if all(os.path.exists(prediction_path) for prediction_path in prediction_paths):
+                continue
+
+            assert os.path.exists(image_path), image_path
+            assert os.path.exists(gt_path), gt_path
+
+            image = imageio.imread(image_path)
+            gt = _load_gt(gt_path)
+
+            embedding_path = os.path.join(embedding_dir, f"{os.path.splitext(image_name)[0]}.zarr")
+
+            _run_inference_with_iterative_prompting_for_image(
+                predictor, image, gt, start_with_box_prompt=start_with_box_prompt,
+                dilation=dilation, batch_size=batch_size, embedding_path=embedding_path,
+                n_iterations=n_iterations, prediction_paths=prediction_paths,
+                io_pool=io_pool, write_futures=write_futures, use_fp16=use_fp16,
+            )
 
-        _run_inference_with_iterative_prompting_for_image(
-            predictor, image, gt, start_with_box_prompt=start_with_box_prompt,
-            dilation=dilation, batch_size=batch_size, embedding_path=embedding_path,
-            n_iterations=n_iterations, prediction_paths=prediction_paths
-        )
+    # Make sure that errors during writing are not silently ignored.
+    for write_future in write_futures:
+        write_future.result()
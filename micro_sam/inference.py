@@ -13,19 +13,20 @@ from .instance_segmentation import mask_data_to_segmentation
 from ._vendored import batched_mask_to_box
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def batched_inference(
     predictor: SamPredictor,
     image: np.ndarray,
     batch_size: int,
-    boxes: Optional[np.ndarray] = None,
-    points: Optional[np.ndarray] = None,
-    point_labels: Optional[np.ndarray] = None,
+    boxes: Optional[Union[np.ndarray, torch.Tensor]] = None,
+    points: Optional[Union[np.ndarray, torch.Tensor]] = None,
+    point_labels: Optional[Union[np.ndarray, torch.Tensor]] = None,
     multimasking: bool = False,
     embedding_path: Optional[Union[str, os.PathLike]] = None,
     return_instance_segmentation: bool = True,
     segmentation_ids: Optional[list] = None,
-    reduce_multimasking: bool = True
+    reduce_multimasking: bool = True,
+    use_fp16: bool = False,
 ):
     """Run batched inference for input prompts.
 
@@ -33,11 +34,11 @@ def batched_inference(
         predictor: The segment anything predictor.
         image: The input image.
         batch_size: The batch size to use for inference.
-        boxes: The box prompts. Array of shape N_PROMPTS x 4.
+        boxes: The box prompts. Array or tensor of shape N_PROMPTS x 4.
             The bounding boxes are represented by [MIN_X, MIN_Y, MAX_X, MAX_Y].
-        points: The point prompt coordinates. Array of shape N_PROMPTS x 2.
+        points: The point prompt coordinates. Array or tensor of shape N_PROMPTS x 2.
             The points are represented by [X, Y].
-        point_labels: The point prompt labels. Array of shape N_PROMPTS x 1.
+        point_labels: The point prompt labels. Array or tensor of shape N_PROMPTS x 1.
             The labels are either 0 (negative prompt) or 1 (positive prompt).
         multimasking: Whether to predict with 3 or 1 mask.
         embedding_path: Cache path for the image embeddings.
@@ -47,6 +48,7 @@ def batched_inference(
             derived from the prompts.
         reduce_multimasking: Whether to choose the most likely masks with
             highest ious from multimasking
+        use_fp16: Whether to run the prompt encoder and mask decoder in half precision on the GPU.
 
     Returns:
         The predicted segmentation masks.
@@ -95,13 +97,21 @@ def batched_inference(
     device = predictor.device
     transform_function = ResizeLongestSide(1024)
     image_shape = predictor.original_size
+    # If the prompts are passed as tensors we move them to the device first and transform them there.
+    # Otherwise we transform them in numpy and then create the tensors directly on the device.
     if have_boxes:
-        boxes = transform_function.apply_boxes(boxes, image_shape)
-        boxes = torch.tensor(boxes, dtype=torch.float32).to(device)
+        if torch.is_tensor(boxes):
+            boxes = transform_function.apply_boxes_torch(boxes.to(device, non_blocking=True), image_shape)
+        else:
+            boxes = transform_function.apply_boxes(boxes, image_shape)
+        boxes = torch.as_tensor(boxes, dtype=torch.float32, device=device)
     if have_points:
-        points = transform_function.apply_coords(points, image_shape)
-        points = torch.tensor(points, dtype=torch.float32).to(device)
-        point_labels = torch.tensor(point_labels, dtype=torch.float32).to(device)
+        if torch.is_tensor(points):
+            points = transform_function.apply_coords_torch(points.to(device, non_blocking=True), image_shape)
+        else:
+            points = transform_function.apply_coords(points, image_shape)
+        points = torch.as_tensor(points, dtype=torch.float32, device=device)
+        point_labels = torch.as_tensor(point_labels, dtype=torch.float32, device=device)
 
     masks = amg_utils.MaskData()
     for batch_idx in range(n_batches):
@@ -112,18 +122,21 @@ def batched_inference(
         batch_points = points[batch_start:batch_stop] if have_points else None
         batch_labels = point_labels[batch_start:batch_stop] if have_points else None
 
-        batch_masks, batch_ious, _ = predictor.predict_torch(
-            point_coords=batch_points, point_labels=batch_labels,
-            boxes=batch_boxes, multimask_output=multimasking
-        )
+        # Run the prompt encoder and mask decoder in half precision if requested and if we are on the GPU.
+        with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=use_fp16 and device.type == "cuda"):
+            batch_masks, batch_ious, _ = predictor.predict_torch(
+                point_coords=batch_points, point_labels=batch_labels,
+                boxes=batch_boxes, multimask_output=multimasking
+            )
+        batch_ious = batch_ious.float()
 
         # If we expect to reduce the masks from multimasking and use multi-masking,
         # then we need to select the most likely mask (according to the predicted IOU) here.
         if reduce_multimasking and multimasking:
             _, max_index = batch_ious.max(axis=1)
-            # How can this be vectorized???
-            batch_masks = torch.cat([batch_masks[i, max_id][None] for i, max_id in enumerate(max_index)]).unsqueeze(1)
-            batch_ious = torch.cat([batch_ious[i, max_id][None] for i, max_id in enumerate(max_index)]).unsqueeze(1)
+            prompt_index = torch.arange(len(max_index), device=max_index.device)
+            batch_masks = batch_masks[prompt_index, max_index].unsqueeze(1)
+            batch_ious = batch_ious[prompt_index, max_index].unsqueeze(1)
 
         batch_data = amg_utils.MaskData(masks=batch_masks.flatten(0, 1), iou_preds=batch_ious.flatten(0, 1))
         batch_data["masks"] = (batch_data["masks"] > predictor.model.mask_threshold).type(torch.bool)
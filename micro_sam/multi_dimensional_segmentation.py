@@ -1,11 +1,20 @@
 """Multi-dimensional segmentation with segment anything.
 """
 
+import math
 import os
-from typing import Any, Optional, Union
+import threading
+from concurrent import futures
+from copy import copy
+from functools import partial
+from typing import Any, Optional, Tuple, Union
 
 import numpy as np
+import torch
+from scipy.ndimage import find_objects, label
 from segment_anything.predictor import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+from torch.nn import functional as F
 from tqdm import tqdm
 
 from . import util
@@ -25,7 +34,9 @@ def segment_mask_in_volume(
     projection: str,
     progress_bar: Optional[Any] = None,
     box_extension: float = 0.0,
-) -> np.ndarray:
+    n_threads: int = 1,
+    return_z_range: bool = False,
+) -> Union[np.ndarray, Tuple[np.ndarray, Tuple[int, int]]]:
     """Segment an object mask in in volumetric data.
 
     Args:
@@ -39,9 +50,13 @@ def segment_mask_in_volume(
         projection: The projection method to use. One of 'mask', 'bounding_box' or 'points'.
         progress_bar: Optional progress bar.
         box_extension: Extension factor for increasing the box size after projection.
+        n_threads: The number of threads used to segment independent slice ranges in parallel.
+            Each thread runs the predictor, so this should only be increased when running on a GPU.
+        return_z_range: Whether to also return the range of slices that were segmented for the object.
 
     Returns:
-        Array with the volumetric segmentation
+        Array with the volumetric segmentation.
+        The first and last slice (inclusive) that were segmented for the object, if `return_z_range` is True.
     """
     assert projection in ("mask", "bounding_box", "points")
     if projection == "mask":
@@ -51,89 +66,319 @@ def segment_mask_in_volume(
     else:
         use_box, use_mask, use_points = True, False, False
 
+    # bind the settings that are the same for all slices, so that they don't have to be passed for each slice
+    # (the predictor is not bound, because each segmentation task below uses its own copy of it)
+    segment_slice = partial(
+        segment_from_mask, image_embeddings=image_embeddings,
+        use_mask=use_mask, use_box=use_box, use_points=use_points, box_extension=box_extension,
+    )
+
+    # The progress bar may be bound to the GUI thread (e.g. napari's progress), so we don't update it
+    # from the threads that run the segmentation. Instead, they count the segmented slices
+    # and the progress bar is updated with this count from the calling thread.
+    progress_lock = threading.Lock()
+    n_segmented = [0]
+
     def _update_progress():
-        if progress_bar is not None:
-            progress_bar.update(1)
+        with progress_lock:
+            n_segmented[0] += 1
 
-    def segment_range(z_start, z_stop, increment, stopping_criterion, threshold=None, verbose=False):
+    # The segmentation functions below return the segmented slices instead of writing them to the segmentation,
+    # so that the independent ranges can be segmented in parallel. They only read the already segmented slices.
+    def segment_range(predictor, z_start, z_stop, increment, stopping_criterion, threshold=None, verbose=False):
+        z_indices, seg_slices = [], []
+        seg_prev = segmentation[z_start]
         z = z_start + increment
         while True:
             if verbose:
                 print(f"Segment {z_start} to {z_stop}: segmenting slice {z}")
-            seg_prev = segmentation[z - increment]
-            seg_z = segment_from_mask(predictor, seg_prev, image_embeddings=image_embeddings, i=z,
-                                      use_mask=use_mask, use_box=use_box, use_points=use_points,
-                                      box_extension=box_extension)
+            # segment_from_mask returns a mask with a leading singleton axis, which we remove here
+            # so that the mask can be used as prompt for the next slice.
+            seg_z = segment_slice(predictor, seg_prev, i=z)[0]
             if threshold is not None:
                 iou = util.compute_iou(seg_prev, seg_z)
                 if iou < threshold:
                     msg = f"Segmentation stopped at slice {z} due to IOU {iou} < {iou_threshold}."
                     print(msg)
                     break
-            segmentation[z] = seg_z
+            z_indices.append(z)
+            seg_slices.append(seg_z)
+            seg_prev = seg_z
             z += increment
             if stopping_criterion(z, z_stop):
                 if verbose:
                     print(f"Segment {z_start} to {z_stop}: stop at slice {z}")
                 break
             _update_progress()
+        return z_indices, seg_slices
+
+    def segment_slice_from_neighbors(predictor, z, seg_below, seg_above):
+        # the object masks are binary, so we can combine them directly without comparing them to 1 first
+        seg_prompt = seg_below.astype(bool, copy=False) | seg_above.astype(bool, copy=False)
+        seg_z = segment_slice(predictor, seg_prompt, i=z)[0]
+        _update_progress()
+        return seg_z
+
+    def segment_gap(predictor, z_start, z_stop, verbose=False):
+        slice_diff = z_stop - z_start
+        z_mid = int((z_start + z_stop) // 2)
+
+        if z_start == z0 and stop_lower:  # the lower slice is stop: we just segment from upper
+            return segment_range(predictor, z_stop, z_start, -1, np.less_equal, verbose=verbose)
+
+        elif z_stop == z1 and stop_upper:  # the upper slice is stop: we just segment from lower
+            return segment_range(predictor, z_start, z_stop, 1, np.greater_equal, verbose=verbose)
+
+        elif slice_diff == 2:  # there is only one slice in between -> use combined mask
+            z = z_start + 1
+            seg_z = segment_slice_from_neighbors(predictor, z, segmentation[z_start], segmentation[z_stop])
+            return [z], [seg_z]
+
+        # there is a range of more than 2 slices in between -> segment ranges
+        # segment from bottom
+        z_indices, seg_slices = segment_range(
+            predictor, z_start, z_mid, 1, np.greater_equal if slice_diff % 2 == 0 else np.greater, verbose=verbose
+        )
+        # segment from top
+        z_indices_top, seg_slices_top = segment_range(predictor, z_stop, z_mid, -1, np.less_equal, verbose=verbose)
+        z_indices, seg_slices = z_indices + z_indices_top, seg_slices + seg_slices_top
+        # if the difference between start and stop is even,
+        # then we have a slice in the middle that is the same distance from top bottom
+        # in this case the slice is not segmented in the ranges above, and we segment it
+        # using the combined mask from the adjacent top and bottom slice as prompt
+        if slice_diff % 2 == 0:
+            gap_segmentation = dict(zip(z_indices, seg_slices))
+            seg_z = segment_slice_from_neighbors(
+                predictor, z_mid, gap_segmentation[z_mid - 1], gap_segmentation[z_mid + 1]
+            )
+            z_indices.append(z_mid)
+            seg_slices.append(seg_z)
+        return z_indices, seg_slices
 
     z0, z1 = int(segmented_slices.min()), int(segmented_slices.max())
 
+    # Collect the independent segmentation tasks.
+    tasks = []
+
     # segment below the min slice
     if z0 > 0 and not stop_lower:
-        segment_range(z0, 0, -1, np.less, iou_threshold)
+        tasks.append(partial(segment_range, z_start=z0, z_stop=0, increment=-1,
+                             stopping_criterion=np.less, threshold=iou_threshold))
 
     # segment above the max slice
     if z1 < segmentation.shape[0] - 1 and not stop_upper:
-        segment_range(z1, segmentation.shape[0] - 1, 1, np.greater, iou_threshold)
+        tasks.append(partial(segment_range, z_start=z1, z_stop=segmentation.shape[0] - 1, increment=1,
+                             stopping_criterion=np.greater, threshold=iou_threshold))
 
     verbose = False
     # segment in between min and max slice
     if z0 != z1:
         for z_start, z_stop in zip(segmented_slices[:-1], segmented_slices[1:]):
-            slice_diff = z_stop - z_start
-            z_mid = int((z_start + z_stop) // 2)
+            if z_stop - z_start == 1:  # the slices are adjacent -> we don't need to do anything
+                continue
+            tasks.append(partial(segment_gap, z_start=z_start, z_stop=z_stop, verbose=verbose))
 
-            if slice_diff == 1:  # the slices are adjacent -> we don't need to do anything
-                pass
+    # Run the tasks in parallel. Each task gets a shallow copy of the predictor,
+    # because setting the image embeddings for a slice changes the predictor state.
+    # The results are written to the segmentation in order, so that the result is deterministic.
+    z_min, z_max = z0, z1
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        task_futures = [tp.submit(task, copy(predictor)) for task in tasks]
 
-            elif z_start == z0 and stop_lower:  # the lower slice is stop: we just segment from upper
-                segment_range(z_stop, z_start, -1, np.less_equal, verbose=verbose)
+        n_reported, pending = 0, set(task_futures)
+        while pending:
+            _, pending = futures.wait(pending, timeout=0.1, return_when=futures.FIRST_COMPLETED)
+            with progress_lock:
+                n_new = n_segmented[0] - n_reported
+            if progress_bar is not None and n_new > 0:
+                progress_bar.update(n_new)
+            n_reported += n_new
 
-            elif z_stop == z1 and stop_upper:  # the upper slice is stop: we just segment from lower
-                segment_range(z_start, z_stop, 1, np.greater_equal, verbose=verbose)
+        for future in task_futures:
+            z_indices, seg_slices = future.result()
+            for z, seg_z in zip(z_indices, seg_slices):
+                segmentation[z] = seg_z
+            if len(z_indices) > 0:
+                z_min, z_max = min(z_min, min(z_indices)), max(z_max, max(z_indices))
 
-            elif slice_diff == 2:  # there is only one slice in between -> use combined mask
-                z = z_start + 1
-                seg_prompt = np.logical_or(segmentation[z_start] == 1, segmentation[z_stop] == 1)
-                segmentation[z] = segment_from_mask(
-                    predictor, seg_prompt, image_embeddings=image_embeddings, i=z,
-                    use_mask=use_mask, use_box=use_box, use_points=use_points,
-                    box_extension=box_extension
-                )
-                _update_progress()
+    if return_z_range:
+        return segmentation, (z_min, z_max)
+    return segmentation
+
+
+def _compute_boxes_from_masks(masks, box_extension):
+    # Compute the bounding boxes (in XYXY format) for a stack of binary masks on the device.
+    # This is the batched equivalent of '_compute_box_from_mask' from 'prompt_based_segmentation'.
+    h, w = masks.shape[-2:]
+    rows, cols = masks.any(dim=2), masks.any(dim=1)
+    ys = torch.arange(h, device=masks.device)[None]
+    xs = torch.arange(w, device=masks.device)[None]
+
+    min_y, max_y = torch.where(rows, ys, h).amin(dim=1), torch.where(rows, ys, -1).amax(dim=1) + 1
+    min_x, max_x = torch.where(cols, xs, w).amin(dim=1), torch.where(cols, xs, -1).amax(dim=1) + 1
+    min_y, max_y, min_x, max_x = min_y.float(), max_y.float(), min_x.float(), max_x.float()
+
+    if box_extension == 0:  # no extension
+        extension_y, extension_x = 0.0, 0.0
+    elif box_extension >= 1:  # extension by a fixed factor
+        extension_y, extension_x = box_extension, box_extension
+    else:  # extension by fraction of the box len
+        extension_y, extension_x = box_extension * (max_y - min_y), box_extension * (max_x - min_x)
+
+    boxes = torch.stack([
+        (min_x - extension_x).clamp(min=0), (min_y - extension_y).clamp(min=0),
+        (max_x + extension_x).clamp(max=w), (max_y + extension_y).clamp(max=h),
+    ], dim=1)
+    return boxes
+
+
+def _compute_logits_from_masks(masks, eps=1e-3):
+    # Compute the mask prompts (logits in the low resolution shape expected by SAM) for a stack of binary masks
+    # on the device. This is the batched equivalent of '_compute_logits_from_mask' from 'prompt_based_segmentation'.
+    logit_value = math.log((1 - eps) / eps)
+    logits = (masks[:, None].float() * 2 - 1) * logit_value
+
+    h, w = masks.shape[-2:]
+    expected_size = 256
+    new_h, new_w = ResizeLongestSide.get_preprocess_shape(h, w, expected_size)
+    if (new_h, new_w) != (h, w):
+        # ResizeLongestSide.apply_image resizes with bilinear interpolation (and antialiasing) via PIL
+        logits = F.interpolate(logits, size=(new_h, new_w), mode="bilinear", antialias=True, align_corners=False)
+
+    # IMPORTANT: need to pad with zero, otherwise SAM doesn't understand the padding
+    logits = F.pad(logits, (0, expected_size - new_w, 0, expected_size - new_h), value=0.0)
+    return logits
+
+
+def _compute_ious(masks1, masks2, eps=1e-7):
+    # Compute the intersection over union for each pair of masks in two stacks of binary masks,
+    # in the same way as 'util.compute_iou' for a single pair of masks.
+    overlap = torch.logical_and(masks1, masks2).flatten(1).sum(dim=1)
+    union = torch.logical_or(masks1, masks2).flatten(1).sum(dim=1)
+    return overlap / (union + eps)
+
+
+def _masks_to_labels(masks, ids):
+    # Convert a stack of object masks to a label image, where overlapping objects are assigned the id of the
+    # object that comes last in the stack (the objects are sorted by id, so the larger ids take precedence).
+    if len(ids) == 0:
+        return torch.zeros(masks.shape[-2:], dtype=torch.int64, device=masks.device)
+    # argmax returns the first maximal index, so we search in the flipped stack to find the last object per pixel
+    last_object = len(ids) - 1 - masks.flip(0).to(torch.uint8).argmax(dim=0)
+    # the pixels without any object are set to 0, which is the "no object" id
+    ids = torch.cat([torch.zeros(1, dtype=torch.int64), torch.from_numpy(np.asarray(ids, dtype="int64"))])
+    ids = ids.to(masks.device)
+    return ids[torch.where(masks.any(dim=0), last_object + 1, 0)]
+
+
+def _segment_objects_in_slice(predictor, masks, image_embeddings, z, use_mask, box_extension, batch_size=32):
+    # Segment all objects in slice z from their masks in the adjacent slice.
+    # All objects share the image embeddings of the slice, so we set them once and predict in batches.
+    # The masks stay on the device, so that the prompts can be derived from them without any transfers.
+    util.set_precomputed(predictor, image_embeddings, i=z)
+
+    segmented_masks = []
+    for batch_start in range(0, len(masks), batch_size):
+        batch_masks = masks[batch_start:batch_start + batch_size]
+
+        boxes = _compute_boxes_from_masks(batch_masks, box_extension)
+        boxes = predictor.transform.apply_boxes_torch(boxes, predictor.original_size)
+        logits = _compute_logits_from_masks(batch_masks) if use_mask else None
+
+        batch_segmented, _, _ = predictor.predict_torch(
+            point_coords=None, point_labels=None, boxes=boxes, mask_input=logits, multimask_output=False,
+        )
+        segmented_masks.append(batch_segmented[:, 0])
 
-            else:  # there is a range of more than 2 slices in between -> segment ranges
-                # segment from bottom
-                segment_range(
-                    z_start, z_mid, 1, np.greater_equal if slice_diff % 2 == 0 else np.greater, verbose=verbose
+    return torch.cat(segmented_masks)
+
+
+@torch.no_grad()
+def _segment_objects_in_volume(
+    segmentation, seg_z, seg_ids, predictor, image_embeddings, z,
+    iou_threshold, use_mask, box_extension, verbose,
+):
+    # Segment all objects from slice z in the volume, by propagating them slice by slice in both directions.
+    # An object is no longer propagated once the IOU to its mask in the previous slice drops below the threshold.
+    # Note that the masks of all propagated objects are kept on the device, i.e. this needs memory for
+    # N_OBJECTS x H x W booleans (plus the predicted masks of one batch of objects) per slice.
+    n_slices = segmentation.shape[0]
+    # seg_z only contains the objects that are segmented, so we can copy it over directly.
+    segmentation[z] = seg_z
+
+    device = predictor.device
+    start_masks = torch.from_numpy(seg_z.astype("int64")).to(device)[None] == \
+        torch.from_numpy(seg_ids.astype("int64")).to(device)[:, None, None]
+
+    with tqdm(total=n_slices - 1, desc="Segment objects in 3d", disable=not verbose) as progress_bar:
+        for increment, z_stop in ((-1, -1), (1, n_slices)):
+            active_ids, prev_masks = seg_ids, start_masks
+
+            z_next = z + increment
+            while z_next != z_stop and len(active_ids) > 0:
+                masks = _segment_objects_in_slice(
+                    predictor, prev_masks, image_embeddings, z_next, use_mask, box_extension
                 )
-                # segment from top
-                segment_range(z_stop, z_mid, -1, np.less_equal, verbose=verbose)
-                # if the difference between start and stop is even,
-                # then we have a slice in the middle that is the same distance from top bottom
-                # in this case the slice is not segmented in the ranges above, and we segment it
-                # using the combined mask from the adjacent top and bottom slice as prompt
-                if slice_diff % 2 == 0:
-                    seg_prompt = np.logical_or(segmentation[z_mid - 1] == 1, segmentation[z_mid + 1] == 1)
-                    segmentation[z_mid] = segment_from_mask(
-                        predictor, seg_prompt, image_embeddings=image_embeddings, i=z_mid,
-                        use_mask=use_mask, use_box=use_box, use_points=use_points,
-                        box_extension=box_extension
-                    )
-                    _update_progress()
 
+                ious = _compute_ious(prev_masks, masks).cpu().numpy()
+
+                keep = ious >= iou_threshold
+                if verbose:
+                    for seg_id, iou in zip(active_ids[~keep], ious[~keep]):
+                        msg = f"Object {seg_id} stopped at slice {z_next} due to IOU {iou} < {iou_threshold}."
+                        print(msg)
+
+                active_ids = active_ids[keep]
+                prev_masks = masks[torch.from_numpy(keep).to(device)]
+
+                # The slice is assembled on the device and then transferred at once.
+                segmentation[z_next] = _masks_to_labels(prev_masks, active_ids).cpu().numpy()
+
+                z_next += increment
+                progress_bar.update(1)
+
+    return segmentation
+
+
+def _segment_objects_individually(
+    segmentation, seg_z, seg_ids, predictor, image_embeddings, z,
+    iou_threshold, projection, box_extension, verbose, n_threads=1,
+):
+    # Segment all objects from slice z in the volume one after the other with 'segment_mask_in_volume'.
+    # We use a single buffer for the segmentation of the individual objects,
+    # and only clear the slices that contain the current object before segmenting the next one.
+    # We compute the bounding boxes of all objects in a single pass, so that we only need to compare the ids
+    # within the bounding box of each object to get its mask.
+    this_seg = np.zeros_like(segmentation)
+    bounding_boxes = find_objects(seg_z)
+    for seg_id in tqdm(seg_ids, desc="Segment objects in 3d", disable=not verbose):
+        bb = bounding_boxes[seg_id - 1]
+        this_seg[z][bb][seg_z[bb] == seg_id] = 1
+        this_seg, (z_min, z_max) = segment_mask_in_volume(
+            this_seg, predictor, image_embeddings,
+            segmented_slices=np.array([z]), stop_lower=False, stop_upper=False,
+            iou_threshold=iou_threshold, projection=projection, box_extension=box_extension,
+            n_threads=n_threads, return_z_range=True,
+        )
+        # we only write and clear the range of slices that were segmented for this object
+        z_range = slice(z_min, z_max + 1)
+        segmentation[z_range][this_seg[z_range] > 0] = seg_id
+        this_seg[z_range] = 0
+    return segmentation
+
+
+def _keep_largest_components(segmentation):
+    # Keep only the largest connected component of each object.
+    # The components are computed in the bounding box of each object, so that we don't process the full volume.
+    for seg_id, bb in enumerate(find_objects(segmentation), start=1):
+        if bb is None:
+            continue
+        object_mask = segmentation[bb] == seg_id
+        components, n_components = label(object_mask)
+        if n_components < 2:
+            continue
+        largest_component = np.bincount(components.ravel())[1:].argmax() + 1
+        segmentation[bb][object_mask & (components != largest_component)] = 0
     return segmentation
 
 
@@ -150,6 +395,8 @@ def segment_3d_from_slice(
     min_object_size_z: int = 50,
     max_object_size_z: Optional[int] = None,
     iou_threshold: float = 0.8,
+    keep_largest_component: bool = False,
+    n_threads: int = 1,
 ):
     """Segment all objects in a volume intersecting with a specific slice.
 
@@ -172,6 +419,15 @@ def segment_3d_from_slice(
         min_object_size_z: Minimal object size in the segmented frame.
         max_object_size_z: Maximal object size in the segmented frame.
         iou_threshold: The IOU threshold for linking objects across slices.
+        keep_largest_component: Whether to only keep the largest connected component of each object
+            in order to remove false positive fragments from the propagation across slices.
+        n_threads: The number of threads used to segment the slices below and above the start slice in parallel.
+            This only has an effect if the objects are segmented individually (see below),
+            and should only be increased when running on a GPU.
+
+    Unless point prompts are used for the projection or the embeddings are tiled, all objects are propagated
+    across slices together. This keeps the masks of all objects in the current slice on the device,
+    which needs memory proportional to the number of objects times the slice size.
 
     Returns:
         Segmentation volume.
@@ -200,14 +456,22 @@ def segment_3d_from_slice(
     # Segment all objects that were found in 3d.
     seg_ids = np.unique(seg_z)[1:]
     segmentation = np.zeros(raw.shape, dtype=seg_z.dtype)
-    for seg_id in tqdm(seg_ids, desc="Segment objects in 3d", disable=not verbose):
-        this_seg = np.zeros_like(segmentation)
-        this_seg[z][seg_z == seg_id] = 1
-        this_seg = segment_mask_in_volume(
-            this_seg, predictor, image_embeddings,
-            segmented_slices=np.array([z]), stop_lower=False, stop_upper=False,
-            iou_threshold=iou_threshold, projection=projection, box_extension=box_extension,
+
+    # We can segment all objects together, unless we use point prompts (which are derived from each mask
+    # and thus vary in number per object) or tiled embeddings (where each object may be in a different tile).
+    if projection != "points" and image_embeddings["input_size"] is not None:
+        segmentation = _segment_objects_in_volume(
+            segmentation, seg_z, seg_ids, predictor, image_embeddings, z,
+            iou_threshold=iou_threshold, use_mask=projection == "mask",
+            box_extension=box_extension, verbose=verbose,
+        )
+    else:
+        segmentation = _segment_objects_individually(
+            segmentation, seg_z, seg_ids, predictor, image_embeddings, z,
+            iou_threshold=iou_threshold, projection=projection,
+            box_extension=box_extension, verbose=verbose, n_threads=n_threads,
         )
-        segmentation[this_seg > 0] = seg_id
 
+    if keep_largest_component:
+        segmentation = _keep_largest_components(segmentation)
     return segmentation
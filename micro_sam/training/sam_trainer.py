@@ -1,6 +1,7 @@
 import os
 import time
 import random
+from concurrent import futures
 from typing import Optional
 
 import numpy as np
@@ -55,6 +56,10 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
         self.mask_prob = mask_prob
         self._kwargs = kwargs
 
+        # use the channels last memory format for the convolutions in the image encoder (patch embedding and neck)
+        # mixed precision is handled by the 'forward_context' of the DefaultTrainer, if 'mixed_precision' is set
+        self.model.sam.image_encoder.to(memory_format=torch.channels_last)
+
     def _get_prompt_and_multimasking_choices(self, current_iteration):
         """Choose the type of prompts we sample for training, and then we call
         'convert_inputs' with the correct prompting from here.
@@ -167,12 +172,15 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
         """ "masks" look like -> (B, 1, X, Y)
         where, B is the number of objects, (X, Y) is the input image shape
         """
-        instance_labels = []
-        for m in masks:
-            instance_list = [self._sigmoid(_val) for _val in m.squeeze(1)]
-            instance_label = torch.stack(instance_list, dim=0).sum(dim=0).clip(0, 1)
-            instance_labels.append(instance_label)
-        instance_labels = torch.stack(instance_labels).unsqueeze(1)
+        # apply the sigmoid to the objects of all images at once,
+        # and then merge the objects per image by summing them up with index_add
+        n_objects = torch.tensor([m.shape[0] for m in masks])
+        masks = self._sigmoid(torch.cat(masks, dim=0).squeeze(1))
+        image_index = torch.repeat_interleave(torch.arange(len(n_objects)), n_objects).to(masks.device)
+        instance_labels = torch.zeros(
+            (len(n_objects),) + masks.shape[1:], dtype=masks.dtype, device=masks.device
+        ).index_add_(0, image_index, masks).clip(0, 1)
+        instance_labels = instance_labels.unsqueeze(1)
         return instance_labels
 
     def _get_val_metric(self, batched_outputs, sampled_binary_y):
@@ -195,7 +203,7 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
     #
     def _update_masks(self, batched_inputs, y, sampled_binary_y, sampled_ids, num_subiter, multimask_output):
         # estimating the image inputs to make the computations faster for the decoder
-        input_images = torch.stack([self.model.preprocess(x=x["image"].to(self.device)) for x in batched_inputs], dim=0)
+        input_images = self.model.preprocess_batched_inputs(batched_inputs)
         image_embeddings = self.model.image_embeddings_oft(input_images)
 
         loss, mask_loss, iou_regression_loss, mean_model_iou = 0.0, 0.0, 0.0, 0.0
@@ -216,22 +224,8 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
             iou_regression_loss += net_iou_regression_loss
             mean_model_iou += net_mean_model_iou
 
-            masks, logits_masks = [], []
-            # the loop below gets us the masks and logits from the batch-level outputs
-            for m in batched_outputs:
-                mask, l_mask = [], []
-                for _m, _l, _iou in zip(m["masks"], m["low_res_masks"], m["iou_predictions"]):
-                    best_iou_idx = torch.argmax(_iou)
-                    best_mask, best_logits = _m[best_iou_idx][None], _l[best_iou_idx][None]
-                    mask.append(self._sigmoid(best_mask))
-                    l_mask.append(best_logits)
-
-                mask, l_mask = torch.stack(mask), torch.stack(l_mask)
-                masks.append(mask)
-                logits_masks.append(l_mask)
-
-            masks, logits_masks = torch.stack(masks), torch.stack(logits_masks)
-            masks = (masks > 0.5).to(torch.float32)
+            masks, logits_masks = self._get_best_masks_and_logits(batched_outputs)
+            masks = (self._sigmoid(masks) > 0.5).to(torch.float32)
 
             self._get_updated_points_per_mask_per_subiter(masks, sampled_binary_y, batched_inputs, logits_masks)
 
@@ -242,6 +236,18 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
 
         return loss, mask_loss, iou_regression_loss, mean_model_iou
 
+    def _get_best_masks_and_logits(self, batched_outputs):
+        # get the masks and logits with the highest predicted iou for each object from the batch-level outputs
+        # (all have the shape B x NUM_OBJECTS x NUM_MASKS x ..., the iou predictions have no spatial axes)
+        masks = torch.stack([m["masks"] for m in batched_outputs])
+        logits_masks = torch.stack([m["low_res_masks"] for m in batched_outputs])
+        ious = torch.stack([m["iou_predictions"] for m in batched_outputs])
+
+        best_iou_idx = ious.argmax(dim=-1)[..., None, None, None]
+        masks = masks.gather(2, best_iou_idx.expand(-1, -1, 1, *masks.shape[-2:]))
+        logits_masks = logits_masks.gather(2, best_iou_idx.expand(-1, -1, 1, *logits_masks.shape[-2:]))
+        return masks, logits_masks
+
     def _get_updated_points_per_mask_per_subiter(self, masks, sampled_binary_y, batched_inputs, logits_masks):
         # here, we get the pair-per-batch of predicted and true elements (and also the "batched_inputs")
         for x1, x2, _inp, logits in zip(masks, sampled_binary_y, batched_inputs, logits_masks):
@@ -274,6 +280,16 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
         n_samples = min(num_instances_gt) if n_samples > min(num_instances_gt) else n_samples
         return n_samples
 
+    def _get_sampled_ids_tensor(self, sampled_ids, device):
+        """Convert the sampled ids per sample to a tensor of shape (B, K), where K is the maximal number of ids.
+        Samples with fewer ids are padded with -1, which does not match any label.
+        """
+        n_ids = max(len(ids) for ids in sampled_ids)
+        ids_tensor = torch.full((len(sampled_ids), n_ids), -1, dtype=torch.int64)
+        for i, ids in enumerate(sampled_ids):
+            ids_tensor[i, :len(ids)] = torch.as_tensor(np.asarray(ids, dtype="int64"))
+        return ids_tensor.to(device)
+
     def _train_epoch_impl(self, progress, forward_context, backprop):
         self.model.train()
 
@@ -281,7 +297,7 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
         t_per_iter = time.time()
         for x, y in self.train_loader:
 
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
             with forward_context():
                 n_samples = self._update_samples_for_gt_instances(y, self.n_objects_per_batch)
@@ -291,18 +307,14 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
                 batched_inputs, sampled_ids = self.convert_inputs(x, y, n_pos, n_neg, get_boxes, n_samples)
 
                 assert len(y) == len(sampled_ids)
-                sampled_binary_y = []
-                for i in range(len(y)):
-                    _sampled = [torch.isin(y[i], torch.tensor(idx)) for idx in sampled_ids[i]]
-                    sampled_binary_y.append(_sampled)
-
                 # the steps below are done for one reason in a gist:
                 # to handle images where there aren't enough instances as expected
                 # (e.g. where one image has only one instance)
-                obj_lengths = [len(s) for s in sampled_binary_y]
-                sampled_binary_y = [s[:min(obj_lengths)] for s in sampled_binary_y]
-                sampled_binary_y = [torch.stack(s).to(torch.float32) for s in sampled_binary_y]
-                sampled_binary_y = torch.stack(sampled_binary_y)
+                # hence we only keep as many objects per image as the image with the fewest objects has
+                n_objects = min(len(ids) for ids in sampled_ids)
+                ids = self._get_sampled_ids_tensor(sampled_ids, y.device)[:, :n_objects]
+                # compare the labels against all object ids at once: (B, 1, 1, H, W) vs. (B, K, 1, 1, 1)
+                sampled_binary_y = (y.unsqueeze(1) == ids[:, :, None, None, None]).to(torch.float32)
 
                 # gist for below - while we find the mismatch, we need to update the batched inputs
                 # else it would still generate masks using mismatching prompts, and it doesn't help us
@@ -339,7 +351,10 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
         self.model.eval()
 
         val_iteration = 0
-        metric_val, loss_val, model_iou_val = 0.0, 0.0, 0.0
+        # we accumulate the validation values on the device, so that we only need to synchronize after the loop
+        metric_val = torch.zeros((), device=self.device)
+        loss_val = torch.zeros((), device=self.device)
+        model_iou_val = torch.zeros((), device=self.device)
 
         with torch.no_grad():
             for x, y in self.val_loader:
@@ -354,23 +369,25 @@ class SamTrainer(torch_em.trainer.DefaultTrainer):
                     batched_outputs = self.model(batched_inputs, multimask_output=multimask_output)
 
                     assert len(y) == len(sampled_ids)
-                    sampled_binary_y = torch.stack(
-                        [torch.isin(y[i], torch.tensor(sampled_ids[i])) for i in range(len(y))]
-                    ).to(torch.float32)
+                    # compare the labels against all object ids at once: (B, 1, H, W, 1) vs. (B, 1, 1, 1, K)
+                    ids = self._get_sampled_ids_tensor(sampled_ids, y.device)
+                    sampled_binary_y = (
+                        y.unsqueeze(-1) == ids[:, None, None, None, :]
+                    ).any(dim=-1).to(torch.float32)
 
                     loss, mask_loss, iou_regression_loss, model_iou = self._get_net_loss(batched_outputs,
                                                                                          y, sampled_ids)
 
                     metric = self._get_val_metric(batched_outputs, sampled_binary_y)
 
-                loss_val += loss.item()
-                metric_val += metric.item()
-                model_iou_val += model_iou.item()
+                loss_val += loss.float()
+                metric_val += metric.float()
+                model_iou_val += model_iou.float()
                 val_iteration += 1
 
-        loss_val /= len(self.val_loader)
-        metric_val /= len(self.val_loader)
-        model_iou_val /= len(self.val_loader)
+        loss_val = loss_val.item() / len(self.val_loader)
+        metric_val = metric_val.item() / len(self.val_loader)
+        model_iou_val = model_iou_val.item() / len(self.val_loader)
         print()
         print(f"The Average Dice Score for the Current Epoch is {1 - metric_val}")
 
@@ -394,12 +411,24 @@ class SamLogger(TorchEmLogger):
         self.tb = torch.utils.tensorboard.SummaryWriter(self.log_dir)
         self.log_image_interval = trainer.log_image_interval
 
-    def add_image(self, x, y, samples, name, step):
-        self.tb.add_image(tag=f"{name}/input", img_tensor=x[0], global_step=step)
-        self.tb.add_image(tag=f"{name}/target", img_tensor=y[0], global_step=step)
-        sample_grid = make_grid([sample[0] for sample in samples], nrow=4, padding=4)
+        # the images are encoded and written in a background thread, so that logging doesn't stall training
+        self._image_writer = futures.ThreadPoolExecutor(max_workers=1)
+        self._image_future = None
+
+    def _write_images(self, x, y, samples, name, step):
+        self.tb.add_image(tag=f"{name}/input", img_tensor=x, global_step=step)
+        self.tb.add_image(tag=f"{name}/target", img_tensor=y, global_step=step)
+        sample_grid = make_grid(samples, nrow=4, padding=4)
         self.tb.add_image(tag=f"{name}/samples", img_tensor=sample_grid, global_step=step)
 
+    def add_image(self, x, y, samples, name, step):
+        # wait for the previous images to be written, so that errors are raised and the images don't pile up
+        if self._image_future is not None:
+            self._image_future.result()
+        x, y = x[0].detach().cpu(), y[0].detach().cpu()
+        samples = [sample[0].detach().cpu() for sample in samples]
+        self._image_future = self._image_writer.submit(self._write_images, x, y, samples, name, step)
+
     def log_train(self, step, loss, lr, x, y, samples, mask_loss, iou_regression_loss, model_iou):
         self.tb.add_scalar(tag="train/loss", scalar_value=loss, global_step=step)
         self.tb.add_scalar(tag="train/mask_loss", scalar_value=mask_loss, global_step=step)
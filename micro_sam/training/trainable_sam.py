@@ -43,6 +43,17 @@ class TrainableSAM(nn.Module):
         x = F.pad(x, (0, padw, 0, padh))
         return x
 
+    def preprocess_batched_inputs(self, batched_inputs):
+        """@private"""
+        images = [x["image"] for x in batched_inputs]
+        # If all images have the same shape we stack them, so that they are copied to the device
+        # and normalized in one go. Otherwise we have to preprocess them one by one.
+        if all(im.shape == images[0].shape for im in images):
+            input_images = self.preprocess(torch.stack(images).to(self.device))
+        else:
+            input_images = torch.stack([self.preprocess(x=im.to(self.device)) for im in images], dim=0)
+        return input_images
+
     def image_embeddings_oft(self, input_images):
         """@private"""
         image_embeddings = self.sam.image_encoder(input_images)
@@ -65,7 +76,7 @@ class TrainableSAM(nn.Module):
         Returns:
             The predicted segmentation masks and iou values.
         """
-        input_images = torch.stack([self.preprocess(x=x["image"].to(self.device)) for x in batched_inputs], dim=0)
+        input_images = self.preprocess_batched_inputs(batched_inputs)
         if image_embeddings is None:
             image_embeddings = self.sam.image_encoder(input_images)
 
@@ -2,9 +2,11 @@ import os
 from typing import List, Optional, Union
 
 import numpy as np
+import torch
+from scipy.ndimage import find_objects
 
 from ..prompt_generators import PointAndBoxPromptGenerator
-from ..util import get_centers_and_bounding_boxes, get_sam_model, segmentation_to_one_hot, _get_device
+from ..util import get_sam_model, _get_device
 from .trainable_sam import TrainableSAM
 
 
@@ -74,8 +76,6 @@ class ConvertToSamInputs:
     def _get_prompt_lists(self, gt, n_samples, prompt_generator):
         """Returns a list of "expected" prompts subjected to the random input attributes for prompting."""
 
-        _, bbox_coordinates = get_centers_and_bounding_boxes(gt, mode="p")
-
         # get the segment ids
         cell_ids = np.unique(gt)[1:]
         if n_samples is None:  # n-samples is set to None, so we use all ids
@@ -85,11 +85,14 @@ class ConvertToSamInputs:
             sampled_cell_ids = np.random.choice(cell_ids, size=min(n_samples, len(cell_ids)), replace=False)
             sampled_cell_ids = np.sort(sampled_cell_ids)
 
-        # only keep the bounding boxes for sampled cell ids
-        bbox_coordinates = [bbox_coordinates[sampled_id] for sampled_id in sampled_cell_ids]
+        # get the bounding boxes for the sampled cell ids (in the same format as 'get_centers_and_bounding_boxes')
+        # we don't need the centers here, so we only compute the bounding boxes with find_objects
+        bounding_boxes = find_objects(gt)
+        bounding_boxes = [bounding_boxes[sampled_id - 1] for sampled_id in sampled_cell_ids]
+        bbox_coordinates = [tuple(sl.start for sl in bb) + tuple(sl.stop for sl in bb) for bb in bounding_boxes]
 
-        # convert the gt to the one-hot-encoded masks for the sampled cell ids
-        object_masks = segmentation_to_one_hot(gt, None if n_samples is None else sampled_cell_ids)
+        # get the masks for the sampled cell ids with a single broadcasted comparison (shape NUM_OBJECTS x 1 x H x W)
+        object_masks = torch.from_numpy(gt[None] == sampled_cell_ids[:, None, None]).unsqueeze(1).to(torch.float32)
 
         # derive and return the prompts
         point_prompts, point_label_prompts, box_prompts, _ = prompt_generator(object_masks, bbox_coordinates)
@@ -6,6 +6,7 @@ import hashlib
 import os
 import pickle
 import warnings
+import weakref
 from collections import OrderedDict
 from shutil import copyfileobj
 from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
@@ -20,7 +21,7 @@ import zarr
 
 from elf.io import open_file
 from nifty.tools import blocking
-from skimage.measure import regionprops
+from scipy.ndimage import center_of_mass, find_objects
 from skimage.segmentation import relabel_sequential
 
 try:
@@ -616,6 +617,38 @@ def precompute_image_embeddings(
     return image_embeddings
 
 
+# The embeddings that were last loaded by 'set_precomputed', together with the features they were loaded from,
+# the index and the device. Setting the same embeddings again (e.g. for several prompts in the same slice,
+# or for several objects in the same slice) then does not read and transfer them again.
+_PRECOMPUTED_CACHE = None
+
+
+def _load_precomputed_features(features, i, device):
+    global _PRECOMPUTED_CACHE
+    # This function can be called from several threads, so we read the cache only once
+    # (assigning the cache is atomic, so the local copy stays consistent).
+    cache = _PRECOMPUTED_CACHE
+    if cache is not None:
+        features_ref, cached_i, cached_device, cached_features = cache
+        if features_ref() is features and cached_i == i and cached_device == device:
+            return cached_features
+
+    if i is None:
+        loaded_features = features.to(device) if torch.is_tensor(features) else \
+            torch.from_numpy(features[:]).to(device)
+    else:
+        loaded_features = features[i].to(device) if torch.is_tensor(features) else \
+            torch.from_numpy(features[i]).to(device)
+
+    # We only keep a weak reference to the features, so that the cache does not keep them alive.
+    try:
+        _PRECOMPUTED_CACHE = (weakref.ref(features), i, device, loaded_features)
+    except TypeError:  # the features do not support weak references
+        _PRECOMPUTED_CACHE = None
+
+    return loaded_features
+
+
 def set_precomputed(
     predictor: SamPredictor,
     image_embeddings: ImageEmbeddings,
@@ -638,12 +671,7 @@ def set_precomputed(
     elif features.ndim == 4 and i is not None:
         raise ValueError("The data is 2D so an index is not needed.")
 
-    if i is None:
-        predictor.features = features.to(device) if torch.is_tensor(features) else \
-            torch.from_numpy(features[:]).to(device)
-    else:
-        predictor.features = features[i].to(device) if torch.is_tensor(features) else \
-            torch.from_numpy(features[i]).to(device)
+    predictor.features = _load_precomputed_features(features, i, device)
     predictor.original_size = image_embeddings["original_size"]
     predictor.input_size = image_embeddings["input_size"]
     predictor.is_image_set = True
@@ -683,24 +711,29 @@ def get_centers_and_bounding_boxes(
         segmentation: The segmentation.
         mode: Determines the functionality used for computing the centers.
         If 'v', the object's eccentricity centers computed by vigra are used.
-        If 'p' the object's centroids computed by skimage are used.
+        If 'p' the object's centroids are used.
 
     Returns:
         A dictionary that maps object ids to the corresponding centroid.
         A dictionary that maps object_ids to the corresponding bounding box.
     """
-    assert mode in ["p", "v"], "Choose either 'p' for regionprops or 'v' for vigra"
+    assert mode in ["p", "v"], "Choose either 'p' for centroids or 'v' for vigra"
 
-    properties = regionprops(segmentation)
+    # find_objects computes the bounding boxes for all objects in a single pass.
+    # We bring them to the same format as the 'bbox' attribute of skimage.measure.regionprops.
+    bbox_coordinates = {
+        label_id: tuple(sl.start for sl in bb) + tuple(sl.stop for sl in bb)
+        for label_id, bb in enumerate(find_objects(segmentation), start=1) if bb is not None
+    }
 
     if mode == "p":
-        center_coordinates = {prop.label: prop.centroid for prop in properties}
+        label_ids = list(bbox_coordinates.keys())
+        centers = center_of_mass(segmentation > 0, labels=segmentation, index=label_ids) if label_ids else []
+        center_coordinates = dict(zip(label_ids, centers))
     elif mode == "v":
         center_coordinates = vigra.filters.eccentricityCenters(segmentation.astype('float32'))
         center_coordinates = {i: coord for i, coord in enumerate(center_coordinates) if i > 0}
 
-    bbox_coordinates = {prop.label: prop.bbox for prop in properties}
-
     assert len(bbox_coordinates) == len(center_coordinates), f"{len(bbox_coordinates)}, {len(center_coordinates)}"
     return center_coordinates, bbox_coordinates
 
@@ -0,0 +1,95 @@
+import os
+import pickle
+import unittest
+import warnings
+from shutil import rmtree
+
+import numpy as np
+
+
+class TestEvaluation(unittest.TestCase):
+    tmp_folder = "tmp-evaluation"
+
+    def setUp(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+    def tearDown(self):
+        rmtree(self.tmp_folder)
+
+    @staticmethod
+    def _get_point_prompts(n_objects_per_image=(3, 0, 5)):
+        prompts = {}
+        for i, n_objects in enumerate(n_objects_per_image):
+            points = np.random.rand(n_objects, 4, 2).astype("float32")
+            labels = np.random.randint(0, 2, size=(n_objects, 4)).astype("int64")
+            prompts[f"image-{i}.tif"] = (points, labels)
+        return prompts
+
+    @staticmethod
+    def _get_box_prompts(n_objects_per_image=(3, 0, 5)):
+        return {
+            f"image-{i}.tif": np.random.rand(n_objects, 4).astype("float32")
+            for i, n_objects in enumerate(n_objects_per_image)
+        }
+
+    def _check_prompts(self, prompt_file, expected_prompts):
+        from micro_sam.evaluation.inference import _load_prompt_file, _get_prompts_from_file
+
+        prompt_data = _load_prompt_file(prompt_file)
+        for name, expected in expected_prompts.items():
+            prompts = _get_prompts_from_file(prompt_data, name)
+            if isinstance(expected, tuple):
+                self.assertEqual(len(prompts), 2)
+                for prompt, expected_prompt in zip(prompts, expected):
+                    self.assertEqual(prompt.shape, expected_prompt.shape)
+                    self.assertTrue(np.array_equal(prompt, expected_prompt))
+            else:
+                self.assertEqual(prompts.shape, expected.shape)
+                self.assertTrue(np.array_equal(prompts, expected))
+
+    def test_prompt_file_round_trip(self):
+        from micro_sam.evaluation.inference import _save_prompt_file
+
+        point_prompts = self._get_point_prompts()
+        point_file = os.path.join(self.tmp_folder, "points-p2-n2.npz")
+        _save_prompt_file(point_file, point_prompts)
+        self._check_prompts(point_file, point_prompts)
+
+        box_prompts = self._get_box_prompts()
+        box_file = os.path.join(self.tmp_folder, "boxes.npz")
+        _save_prompt_file(box_file, box_prompts)
+        self._check_prompts(box_file, box_prompts)
+
+    def test_prompt_file_rewrite(self):
+        from micro_sam.evaluation.inference import _save_prompt_file
+
+        box_file = os.path.join(self.tmp_folder, "boxes.npz")
+        box_prompts = self._get_box_prompts()
+        _save_prompt_file(box_file, box_prompts)
+        self._check_prompts(box_file, box_prompts)
+
+        # rewrite the file with different prompts and make sure that the cached prompts are not used
+        box_prompts = self._get_box_prompts((2, 4, 1))
+        _save_prompt_file(box_file, box_prompts)
+        stat = os.stat(box_file)
+        os.utime(box_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self._check_prompts(box_file, box_prompts)
+
+    def test_legacy_prompt_file(self):
+        from micro_sam.evaluation.inference import _convert_legacy_prompt_file
+
+        point_prompts = self._get_point_prompts()
+        with open(os.path.join(self.tmp_folder, "points-p2-n2.pkl"), "wb") as f:
+            pickle.dump(point_prompts, f)
+
+        point_file = os.path.join(self.tmp_folder, "points-p2-n2.npz")
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            _convert_legacy_prompt_file(point_file)
+        self.assertEqual(len(w), 1)
+        self.assertTrue(os.path.exists(point_file))
+        self._check_prompts(point_file, point_prompts)
+
+
+if __name__ == "__main__":
+    unittest.main()
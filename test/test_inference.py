@@ -0,0 +1,50 @@
+import unittest
+
+import micro_sam.util as util
+import numpy as np
+import torch
+
+from skimage.draw import disk
+
+
+class TestInference(unittest.TestCase):
+    model_type = "vit_t" if util.VIT_T_SUPPORT else "vit_b"
+
+    @staticmethod
+    def _get_input(shape=(256, 256)):
+        labels = np.zeros(shape, dtype="uint32")
+        centers = [(64, 64), (64, 192), (192, 128)]
+        for seg_id, center in enumerate(centers, start=1):
+            labels[disk(center, radius=20, shape=shape)] = seg_id
+        image = (labels > 0).astype("uint8") * 255
+        return image, labels
+
+    def test_batched_inference_tensor_prompts(self):
+        from micro_sam.inference import batched_inference
+
+        image, labels = self._get_input()
+        predictor = util.get_sam_model(model_type=self.model_type)
+
+        _, bounding_boxes = util.get_centers_and_bounding_boxes(labels, mode="p")
+        # the boxes are given in XYXY format and the points in XY format
+        boxes = np.array([[bb[1], bb[0], bb[3], bb[2]] for bb in bounding_boxes.values()])
+        points = np.array([[[(bb[1] + bb[3]) // 2, (bb[0] + bb[2]) // 2]] for bb in bounding_boxes.values()])
+        point_labels = np.ones(points.shape[:2], dtype="int64")
+
+        # the prompts passed as numpy arrays and as tensors give the same segmentation
+        prompt_settings = [
+            {"boxes": boxes},
+            {"points": points, "point_labels": point_labels},
+            {"boxes": boxes, "points": points, "point_labels": point_labels},
+        ]
+        for prompts in prompt_settings:
+            segmentation = batched_inference(predictor, image, batch_size=2, **prompts)
+            segmentation_tensor = batched_inference(
+                predictor, image, batch_size=2, **{name: torch.from_numpy(val) for name, val in prompts.items()}
+            )
+            self.assertTrue(np.array_equal(segmentation, segmentation_tensor))
+            self.assertGreater(util.compute_iou(segmentation > 0, labels > 0), 0.8)
+
+
+if __name__ == "__main__":
+    unittest.main()
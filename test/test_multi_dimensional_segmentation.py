@@ -0,0 +1,204 @@
+import unittest
+from unittest import mock
+
+import micro_sam.util as util
+import numpy as np
+import torch
+
+from skimage.draw import disk
+
+
+class TestMultiDimensionalSegmentation(unittest.TestCase):
+    model_type = "vit_t" if util.VIT_T_SUPPORT else "vit_b"
+
+    @staticmethod
+    def _get_masks(shape, n_masks=4):
+        masks = np.zeros((n_masks,) + shape, dtype="bool")
+        for i, mask in enumerate(masks):
+            center = (shape[0] // 4 + 16 * i, shape[1] // 3 + 8 * i)
+            mask[disk(center, radius=10 + 4 * i, shape=shape)] = 1
+        return masks
+
+    def test_compute_boxes_from_masks(self):
+        from micro_sam.multi_dimensional_segmentation import _compute_boxes_from_masks
+        from micro_sam.prompt_based_segmentation import _compute_box_from_mask
+
+        masks = self._get_masks((128, 160))
+        for box_extension in (0, 0.1, 2):
+            boxes = _compute_boxes_from_masks(torch.from_numpy(masks), box_extension).numpy()
+            expected_boxes = np.stack([
+                _compute_box_from_mask(mask.astype("uint8"), box_extension=box_extension) for mask in masks
+            ])
+            self.assertTrue(np.allclose(boxes, expected_boxes))
+
+    def test_compute_logits_from_masks(self):
+        from micro_sam.multi_dimensional_segmentation import _compute_logits_from_masks
+        from micro_sam.prompt_based_segmentation import _compute_logits_from_mask
+
+        # test a shape that matches the expected shape, a square shape and a non-square shape
+        for shape in ((256, 256), (512, 512), (384, 512)):
+            masks = self._get_masks(shape)
+            logits = _compute_logits_from_masks(torch.from_numpy(masks)).numpy()
+            expected_logits = np.stack([_compute_logits_from_mask(mask.astype("uint8")) for mask in masks])
+            self.assertEqual(logits.shape, expected_logits.shape)
+            # the resizing is not bitwise identical to the resizing with PIL, so we compare with a tolerance
+            self.assertTrue(np.allclose(logits, expected_logits, atol=0.05))
+
+    def test_masks_to_labels(self):
+        from micro_sam.multi_dimensional_segmentation import _masks_to_labels
+
+        masks = self._get_masks((128, 160))
+        ids = np.array([2, 3, 7, 9])
+        labels = _masks_to_labels(torch.from_numpy(masks), ids).numpy()
+
+        # write the objects one after the other, so that the larger ids take precedence
+        expected_labels = np.zeros(masks.shape[1:], dtype="int64")
+        for seg_id, mask in zip(ids, masks):
+            expected_labels[mask] = seg_id
+        self.assertTrue(np.array_equal(labels, expected_labels))
+
+        labels = _masks_to_labels(torch.zeros((0, 128, 160), dtype=torch.bool), np.array([])).numpy()
+        self.assertEqual(labels.shape, (128, 160))
+        self.assertEqual(labels.sum(), 0)
+
+    @staticmethod
+    def _get_volume(shape=(5, 256, 256)):
+        # objects that change their size slightly from slice to slice
+        labels = np.zeros(shape, dtype="uint32")
+        for z in range(shape[0]):
+            labels[z][disk((70, 70), radius=24 + z, shape=shape[1:])] = 1
+            labels[z][disk((170, 90), radius=30 - z, shape=shape[1:])] = 2
+            labels[z][disk((120, 190), radius=22 + z, shape=shape[1:])] = 3
+        raw = (labels > 0).astype("uint8") * 255
+        return raw, labels
+
+    def test_segment_mask_in_volume(self):
+        from micro_sam.multi_dimensional_segmentation import segment_mask_in_volume
+
+        class Progress:
+            def __init__(self):
+                self.n = 0
+
+            def update(self, n):
+                self.n += n
+
+        raw, labels = self._get_volume(shape=(7, 256, 256))
+        predictor = util.get_sam_model(model_type=self.model_type)
+        image_embeddings = util.precompute_image_embeddings(predictor, raw, ndim=3)
+
+        # the object is given in two slices, so that there are three independent ranges to segment:
+        # below the lower slice, above the upper slice and the gap in between
+        segmented_slices = np.array([2, 5])
+        initial_segmentation = np.zeros_like(labels)
+        initial_segmentation[segmented_slices] = labels[segmented_slices] == 1
+
+        # segmenting the ranges in parallel gives the same result as segmenting them one after the other
+        results, progress_counts = [], []
+        for n_threads in (1, 2):
+            progress = Progress()
+            segmentation = segment_mask_in_volume(
+                initial_segmentation.copy(), predictor, image_embeddings, segmented_slices,
+                stop_lower=False, stop_upper=False, iou_threshold=0.8, projection="mask",
+                progress_bar=progress, n_threads=n_threads,
+            )
+            results.append(segmentation)
+            progress_counts.append(progress.n)
+
+        self.assertTrue(np.array_equal(results[0], results[1]))
+        self.assertEqual(progress_counts[0], progress_counts[1])
+        for z in range(raw.shape[0]):
+            self.assertGreater(util.compute_iou(results[1][z], labels[z] == 1), 0.8)
+
+    def test_segment_objects_in_volume(self):
+        from micro_sam.multi_dimensional_segmentation import (
+            _segment_objects_in_volume, _segment_objects_individually
+        )
+
+        raw, labels = self._get_volume()
+        predictor = util.get_sam_model(model_type=self.model_type)
+        image_embeddings = util.precompute_image_embeddings(predictor, raw, ndim=3)
+
+        z = raw.shape[0] // 2
+        seg_z = labels[z]
+        seg_ids = np.unique(seg_z)[1:]
+
+        # propagate all objects together and each object individually with 'segment_mask_in_volume'
+        segmentation = _segment_objects_in_volume(
+            np.zeros_like(labels), seg_z, seg_ids, predictor, image_embeddings, z,
+            iou_threshold=0.8, use_mask=True, box_extension=0.0, verbose=False,
+        )
+        expected_segmentation = _segment_objects_individually(
+            np.zeros_like(labels), seg_z, seg_ids, predictor, image_embeddings, z,
+            iou_threshold=0.8, projection="mask", box_extension=0.0, verbose=False,
+        )
+
+        for seg_id in seg_ids:
+            object_mask, expected_object_mask = segmentation == seg_id, expected_segmentation == seg_id
+
+            # all objects are propagated through the whole volume
+            for this_z in range(raw.shape[0]):
+                self.assertGreater(util.compute_iou(object_mask[this_z], labels[this_z] == seg_id), 0.8)
+
+            # the mask prompts are resized slightly differently, so we don't expect identical results
+            self.assertGreater(util.compute_iou(object_mask, expected_object_mask), 0.95)
+
+    def test_keep_largest_components(self):
+        from micro_sam.multi_dimensional_segmentation import _keep_largest_components
+
+        segmentation = np.zeros((4, 32, 32), dtype="uint32")
+        # object 1 has a large and a small component
+        segmentation[:, 2:12, 2:12] = 1
+        segmentation[0, 20:22, 2:4] = 1
+        # object 2 is empty, object 3 has a single component
+        segmentation[1:3, 20:30, 20:30] = 3
+        # object 4 has three components of different size
+        segmentation[3, 14:16, 14:16] = 4
+        segmentation[0:2, 24:30, 8:14] = 4
+        segmentation[3, 28:30, 28:30] = 4
+
+        expected_segmentation = segmentation.copy()
+        expected_segmentation[0, 20:22, 2:4] = 0
+        expected_segmentation[3, 14:16, 14:16] = 0
+        expected_segmentation[3, 28:30, 28:30] = 0
+
+        segmentation = _keep_largest_components(segmentation)
+        self.assertTrue(np.array_equal(segmentation, expected_segmentation))
+
+    def test_segment_3d_from_slice(self):
+        import micro_sam.multi_dimensional_segmentation as multi_dimensional_segmentation
+        from scipy.ndimage import label
+
+        raw, _ = self._get_volume()
+        predictor = util.get_sam_model(model_type=self.model_type)
+
+        # we keep a copy of the segmentation before selecting the largest components, so that we can compare to it
+        keep_largest_components = multi_dimensional_segmentation._keep_largest_components
+        segmentations_before = []
+
+        def keep_largest_components_and_record(segmentation):
+            segmentations_before.append(segmentation.copy())
+            return keep_largest_components(segmentation)
+
+        with mock.patch.object(
+            multi_dimensional_segmentation, "_keep_largest_components", side_effect=keep_largest_components_and_record
+        ):
+            segmentation = multi_dimensional_segmentation.segment_3d_from_slice(
+                predictor, raw, verbose=False, keep_largest_component=True
+            )
+        self.assertEqual(segmentation.shape, raw.shape)
+        self.assertEqual(len(segmentations_before), 1)
+        segmentation_before = segmentations_before[0]
+
+        seg_ids = np.unique(segmentation)[1:]
+        self.assertGreater(len(seg_ids), 0)
+        for seg_id in seg_ids:
+            object_mask = segmentation == seg_id
+            # each object consists of a single (6-connected) component
+            _, n_components = label(object_mask)
+            self.assertEqual(n_components, 1)
+            # and no object gains voxels by selecting the largest component
+            self.assertFalse(np.logical_and(object_mask, segmentation_before != seg_id).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -185,5 +185,84 @@ class TestTraining(unittest.TestCase):
         # TODO
 
 
+class TestSamTrainer(unittest.TestCase):
+    """Unit tests for the vectorized helper functions of the SamTrainer.
+    """
+
+    @staticmethod
+    def _get_trainer():
+        from micro_sam.training import SamTrainer
+
+        # the helper functions only need the sigmoid, so we don't need to initialize the full trainer
+        trainer = SamTrainer.__new__(SamTrainer)
+        trainer._sigmoid = torch.nn.Sigmoid()
+        return trainer
+
+    @staticmethod
+    def _postprocess_outputs_loop(masks):
+        # the previous implementation, which applies the sigmoid and merges the objects per image and object
+        instance_labels = []
+        for m in masks:
+            instance_list = [torch.sigmoid(_val) for _val in m.squeeze(1)]
+            instance_label = torch.stack(instance_list, dim=0).sum(dim=0).clip(0, 1)
+            instance_labels.append(instance_label)
+        return torch.stack(instance_labels).unsqueeze(1)
+
+    def test_postprocess_outputs(self):
+        trainer = self._get_trainer()
+        shape = (64, 64)
+
+        # test with a single mask and with multimask outputs
+        for n_masks in (1, 3):
+            masks = [torch.randn(4, n_masks, *shape) * 4 for _ in range(3)]
+            instance_labels = trainer._postprocess_outputs(masks)
+            expected_labels = self._postprocess_outputs_loop(masks)
+            self.assertEqual(instance_labels.shape, expected_labels.shape)
+            self.assertTrue(torch.allclose(instance_labels, expected_labels, atol=1e-6))
+
+    def test_postprocess_outputs_different_number_of_objects(self):
+        trainer = self._get_trainer()
+        shape = (64, 64)
+
+        # the objects of all images are merged with a single index_add,
+        # so we check that they are still assigned to the correct image
+        for n_masks in (1, 3):
+            masks = [torch.randn(n_objects, n_masks, *shape) * 4 for n_objects in (1, 5, 2, 7)]
+            instance_labels = trainer._postprocess_outputs(masks)
+            expected_labels = self._postprocess_outputs_loop(masks)
+            self.assertEqual(instance_labels.shape, expected_labels.shape)
+            self.assertTrue(torch.allclose(instance_labels, expected_labels, atol=1e-6))
+
+    def test_get_best_masks_and_logits(self):
+        trainer = self._get_trainer()
+        n_images, n_objects, n_masks = 2, 4, 3
+
+        batched_outputs = [
+            {
+                "masks": torch.randn(n_objects, n_masks, 64, 64),
+                "low_res_masks": torch.randn(n_objects, n_masks, 16, 16),
+                "iou_predictions": torch.rand(n_objects, n_masks),
+            } for _ in range(n_images)
+        ]
+        masks, logits = trainer._get_best_masks_and_logits(batched_outputs)
+
+        # the previous implementation, which selects the best mask and logits per image and object
+        expected_masks, expected_logits = [], []
+        for m in batched_outputs:
+            mask, l_mask = [], []
+            for _m, _l, _iou in zip(m["masks"], m["low_res_masks"], m["iou_predictions"]):
+                best_iou_idx = torch.argmax(_iou)
+                mask.append(_m[best_iou_idx][None])
+                l_mask.append(_l[best_iou_idx][None])
+            expected_masks.append(torch.stack(mask))
+            expected_logits.append(torch.stack(l_mask))
+        expected_masks, expected_logits = torch.stack(expected_masks), torch.stack(expected_logits)
+
+        self.assertEqual(masks.shape, expected_masks.shape)
+        self.assertTrue(torch.equal(masks, expected_masks))
+        self.assertEqual(logits.shape, expected_logits.shape)
+        self.assertTrue(torch.equal(logits, expected_logits))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -48,6 +48,20 @@ class TestUtil(unittest.TestCase):
             self.assertIn("features", f)
             self.assertEqual(len(f["features"]), 4)
 
+    def test_get_centers_and_bounding_boxes(self):
+        from micro_sam.util import get_centers_and_bounding_boxes
+        from skimage.measure import regionprops
+
+        labels = label(binary_blobs(256, blob_size_fraction=0.05, volume_fraction=0.15))
+        centers, boxes = get_centers_and_bounding_boxes(labels, mode="p")
+
+        properties = regionprops(labels)
+        self.assertEqual(len(centers), len(properties))
+        self.assertEqual(len(boxes), len(properties))
+        for prop in properties:
+            self.assertEqual(boxes[prop.label], prop.bbox)
+            self.assertTrue(np.allclose(centers[prop.label], prop.centroid))
+
     def test_segmentation_to_one_hot(self):
         from micro_sam.util import segmentation_to_one_hot
 